@@ -0,0 +1,101 @@
+import numpy as np
+import pyarrow.parquet as pq
+from scipy import ndimage
+
+
+class StreamResampler:
+    """
+    Cubic spline resampler that is fed a signal in consecutive chunks.
+
+    Output sample j is interpolated at input position j * sampling_rate / desired_sampling_rate, so chunks of
+    any size produce the same output as resampling the whole signal at once. The last `margin` input samples of
+    each chunk are held back until the next chunk arrives, which keeps the spline prefilter continuous across
+    chunk boundaries.
+
+    Args:
+    - sampling_rate: the sampling frequency of the input signal.
+    - desired_sampling_rate: the sampling frequency of the output signal.
+    - margin: number of input samples kept either side of a chunk boundary. Default is 32.
+    """
+
+    def __init__(self, sampling_rate, desired_sampling_rate, margin=32):
+        self.step = sampling_rate / desired_sampling_rate
+        self.margin = margin
+        self.buffer = np.zeros(0)
+        self.buffer_start = 0
+        self.n_out = 0
+
+    def process(self, chunk, final=False):
+        """
+        Add the next chunk of input samples and return the output samples that can now be computed.
+
+        Pass final=True with the last chunk (or an empty chunk) to flush the remaining samples.
+        """
+        self.buffer = np.concatenate([self.buffer, np.asarray(chunk, dtype=float)])
+        if len(self.buffer) == 0:
+            return np.zeros(0)
+
+        # only interpolate positions whose spline support is at least margin samples from the buffer end
+        last_pos = self.buffer_start + len(self.buffer) - 1
+        if not final:
+            last_pos -= self.margin
+        n_new = int(np.floor(last_pos / self.step)) + 1 - self.n_out
+        if n_new <= 0:
+            return np.zeros(0)
+
+        pos = (self.n_out + np.arange(n_new)) * self.step - self.buffer_start
+        resampled = ndimage.map_coordinates(self.buffer, [pos], order=3, mode='mirror')
+        self.n_out += n_new
+
+        # drop the input samples that are no longer within the margin of the next output position
+        drop = max(int(np.floor(self.n_out * self.step)) - self.margin - self.buffer_start, 0)
+        self.buffer = self.buffer[drop:]
+        self.buffer_start += drop
+
+        return resampled
+
+
+def iter_parquet_chunks(file_path, chunk_rows):
+    """
+    Yield the first column of a parquet file as 1D numpy arrays of at most chunk_rows values.
+
+    The file is read one row group at a time, so only the current batch is held in memory.
+    """
+    parquet_file = pq.ParquetFile(file_path)
+    column = parquet_file.schema_arrow.names[0]
+    for batch in parquet_file.iter_batches(batch_size=chunk_rows, columns=[column]):
+        yield batch.column(0).to_numpy(zero_copy_only=False)
+
+
+def iter_ecg_windows(ecg_file, sampling_rate, desired_sampling_rate=250, window_s=10, windows_per_chunk=2048):
+    """
+    Stream an ECG parquet file as matrices of consecutive, resampled windows.
+
+    Args:
+    - ecg_file: path to the ECG parquet file.
+    - sampling_rate: the sampling frequency of the stored ECG.
+    - desired_sampling_rate: the sampling frequency of the yielded windows. Default is 250 Hz.
+    - window_s: the window length in seconds. Default is 10 s.
+    - windows_per_chunk: approximate number of windows read per chunk. Default is 2048.
+
+    Yields:
+    - (n_windows, window_s*desired_sampling_rate) arrays of windows. Consecutive arrays continue where the
+      previous one stopped and any incomplete window at the end of the recording is dropped.
+    """
+    window = int(window_s * desired_sampling_rate)
+    chunk_rows = int(np.ceil(windows_per_chunk * window_s * sampling_rate))
+    resampler = StreamResampler(sampling_rate, desired_sampling_rate)
+    pending = np.zeros(0)
+
+    for chunk in iter_parquet_chunks(ecg_file, chunk_rows):
+        pending = np.concatenate([pending, resampler.process(chunk)])
+        n_windows = len(pending) // window
+        if n_windows > 0:
+            yield pending[:n_windows*window].reshape(n_windows, window)
+            pending = pending[n_windows*window:]
+
+    # flush the samples held back by the resampler
+    pending = np.concatenate([pending, resampler.process(np.zeros(0), final=True)])
+    n_windows = len(pending) // window
+    if n_windows > 0:
+        yield pending[:n_windows*window].reshape(n_windows, window)
@@ -1,85 +1,182 @@
 import numpy as np
 import os
+import time
+import multiprocessing
 import matplotlib.pyplot as plt
-import scipy 
+import scipy
 import neurokit2 as nk
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import pandas as pd
 import polars as pl
 
-from orphanidou_nk import assess_qual_hr
+from orphanidou_nk import assess_qual_hr_batch
+from ecg_stream import iter_ecg_windows
 
 #set path directory for data files
 path = '../'
 
-#read in signal freq -> dictionary
-file = open(f"{path}/data/label_freq.txt", 'r')
-label_freq = file.read()
-label_freq = eval(label_freq)
-file.close()
-
 new_ecg_fs = 250
-ecg_fs = label_freq['ECG_A']
 fs = 250
 
-#open the data file to loop through 
-df = pd.read_csv(f"{path}/data/data_files.xlsx")
-
-#loop through the files in the datarame to access each ECG file
 
-for index, row in df.iterrows():
-    #loop through the df get the patient id and the file name 
-    patient_id = row['Patient ID']
-    file_name = row['file_name']
-    print(patient_id)
-    
+def save_npy_atomic(file_path, arr):
+    """
+    Save a numpy array so that file_path only ever holds a complete file.
+
+    The array is written to a temporary file in the same folder and then moved into place with os.replace.
+    """
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, arr)
+    os.replace(tmp_path, file_path)
+
+
+def save_beat_index(file_path, beats, quality, hr, fs, window_len):
+    """
+    Save the R-peak locations found by the HR pass as a compact .npz beat index.
+
+    The beats of every window are stored end to end as absolute sample positions of the resampled ECG, with
+    window_offsets[i]:window_offsets[i+1] selecting the beats of window i (CSR layout).
+
+    Args:
+    - file_path: path of the .npz file to write.
+    - beats: list with the beat locations of each window, relative to the start of the window.
+    - quality: quality flag of each window (1 = acceptable).
+    - hr: HR of each window in bpm.
+    - fs: the sampling frequency of the resampled ECG the beats refer to.
+    - window_len: the number of samples in each window.
+    """
+    counts = np.array([len(b) for b in beats], dtype=np.int64)
+    window_offsets = np.concatenate([[0], np.cumsum(counts)])
+    window_starts = np.repeat(np.arange(len(beats), dtype=np.int64) * window_len, counts)
+    beat_positions = (np.concatenate([np.asarray(b, dtype=np.int64) for b in beats]) if len(beats) else np.zeros(0, dtype=np.int64)) + window_starts
+
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, beat_positions=beat_positions, window_offsets=window_offsets,
+                 quality=np.asarray(quality, dtype=np.int8), hr=np.asarray(hr, dtype=np.float32),
+                 fs=np.int64(fs), window_len=np.int64(window_len))
+    os.replace(tmp_path, file_path)
+
+
+def is_up_to_date(output_file, input_file):
+    """
+    Check whether output_file exists and is newer than input_file.
+    """
+    if not os.path.exists(output_file):
+        return False
+    return os.path.getmtime(output_file) > os.path.getmtime(input_file)
+
+
+def extract_patient_hr(patient_id, file_name, ecg_fs):
+    """
+    Extract the 10s HR values for one patient and save them to hr_values/{patient_id}.npy, along with the beat
+    locations of every window in beat_index/{patient_id}.npz.
+
+    Args:
+    - patient_id: the patient ID of the ECG recording.
+    - file_name: the name of the folder holding the patient's parquet files.
+    - ecg_fs: the sampling frequency of the raw ECG.
+    """
     #set path to the ECG file
-    path = f"{path}/data/bdf_files/{file_name}/{patient_id}/" 
-    
-    #open the ECG A file 
-    df_ecg = pl.read_parquet(path + 'ECG_A.parquet')
-
-    #convert t0 1D numpy array
-    ecg = df_ecg.to_numpy()
-    ecg = ecg.reshape(-1)
-
-    #resample the signal to 250Hz as extracting 10s at current Hz would leave discrepancies in the window size over time
-    ecg = nk.signal_resample(ecg, desired_sampling_rate=new_ecg_fs, sampling_rate=ecg_fs)
-    length = len(ecg)
-    print(len(ecg))
-
-    #calculate the window size for 10s of an ECG
-    window = 10 * new_ecg_fs
-
-    #caluclate what would be left over if dividing ecg in 10s and remove anything leftover
-    leftover = length%window
-    if leftover >0:
-        ecg = ecg[:-leftover]
-
-    n_windows = int(length/window)
-    print(n_windows)
-
-    #reshape the original 1D array into a 2D matrix with 10s windows
-    rows = n_windows
-    cols = window
-    ecg = ecg.reshape(rows, cols)
-    ecg.shape
-
-    #initate lists to store the quality values
-    quality_nk = np.zeros(n_windows)
-    hr_nk = np.zeros(n_windows)
-
-    for i in range(n_windows):
-        #try:
-        qual, hr_full, beats = assess_qual_hr(ecg[i], new_ecg_fs, thresh=0.66)
-        quality_nk[i] = qual
-        hr_nk[i] = hr_full
-        #except:
-            #print(f"error at index {i}")
-            #quality_nk[i] = 0
-            #hr_nk[i] = 0
+    ecg_file = f"{path}/data/bdf_files/{file_name}/{patient_id}/ECG_A.parquet"
+
+    #stream the ECG as blocks of 10s windows resampled to 250Hz, as extracting 10s at current Hz would leave
+    #discrepancies in the window size over time; any incomplete window at the end is dropped
+    hr_blocks = []
+    quality_blocks = []
+    beats = []
+    for ecg in iter_ecg_windows(ecg_file, ecg_fs, desired_sampling_rate=new_ecg_fs, window_s=10):
+        #assess the quality and HR of every 10s window in the block in one batch call
+        quality_nk, hr_nk, beats_nk = assess_qual_hr_batch(ecg, new_ecg_fs, thresh=0.66)
+        hr_blocks.append(hr_nk)
+        quality_blocks.append(quality_nk)
+        beats.extend(beats_nk)
+
+    hr_nk = np.concatenate(hr_blocks) if hr_blocks else np.zeros(0)
+    quality_nk = np.concatenate(quality_blocks) if quality_blocks else np.zeros(0, dtype=int)
+
+    #save the beat locations so HRV features can be computed later without re-reading the ECG
+    save_beat_index(f'{path}/data/beat_index/{patient_id}.npz', beats, quality_nk, hr_nk, new_ecg_fs, 10*new_ecg_fs)
 
     hr_nk = np.round(hr_nk).astype(int)
 
-    #save the quality values array as a .npy file with the same name as the patient id
-    np.save(f'{path}/data/hr_values/{patient_id}.npy', hr_nk)
\ No newline at end of file
+    #save the HR values array as a .npy file with the same name as the patient id
+    save_npy_atomic(f'{path}/data/hr_values/{patient_id}.npy', hr_nk)
+
+
+def run_patient(patient_id, file_name, ecg_fs):
+    """
+    Worker wrapper around extract_patient_hr that records the wall time and any failure instead of raising.
+    """
+    start = time.perf_counter()
+    try:
+        extract_patient_hr(patient_id, file_name, ecg_fs)
+        status, error = 'done', ''
+    except Exception as e:
+        status, error = 'failed', repr(e)
+    return {'Patient ID': patient_id, 'status': status, 'wall_time_s': time.perf_counter() - start, 'error': error}
+
+
+def run_cohort(df, ecg_fs, n_workers=None):
+    """
+    Extract HR for every patient in df with a pool of worker processes.
+
+    Patients whose hr_values/{patient_id}.npy and beat_index/{patient_id}.npz are newer than their ECG_A.parquet are skipped, so an interrupted
+    run can be restarted and only the missing patients are processed. Larger recordings are submitted first
+    so the slowest patients don't start last.
+
+    Args:
+    - df: dataframe with 'Patient ID' and 'file_name' columns.
+    - ecg_fs: the sampling frequency of the raw ECG.
+    - n_workers: number of worker processes. Default is the number of CPUs.
+
+    Returns:
+    - manifest: dataframe with the status, wall time and error message of each patient.
+    """
+    os.makedirs(f'{path}/data/hr_values', exist_ok=True)
+    os.makedirs(f'{path}/data/beat_index', exist_ok=True)
+
+    records = []
+    pending = []
+    for patient_id, file_name in zip(df['Patient ID'], df['file_name']):
+        input_file = f"{path}/data/bdf_files/{file_name}/{patient_id}/ECG_A.parquet"
+        output_files = [f'{path}/data/hr_values/{patient_id}.npy', f'{path}/data/beat_index/{patient_id}.npz']
+        if not os.path.exists(input_file):
+            records.append({'Patient ID': patient_id, 'status': 'failed', 'wall_time_s': 0.0, 'error': 'ECG_A.parquet not found'})
+        elif all(is_up_to_date(output_file, input_file) for output_file in output_files):
+            records.append({'Patient ID': patient_id, 'status': 'skipped', 'wall_time_s': 0.0, 'error': ''})
+        else:
+            pending.append((os.path.getsize(input_file), patient_id, file_name))
+
+    #submit the largest recordings first
+    pending.sort(reverse=True)
+    print(f"{len(pending)} patients to process, {len(records)} skipped or missing", flush=True)
+
+    #spawn fresh workers as forking after polars has started its thread pool can deadlock
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(run_patient, patient_id, file_name, ecg_fs) for _, patient_id, file_name in pending]
+        for future in as_completed(futures):
+            record = future.result()
+            print(f"{record['Patient ID']}: {record['status']} in {record['wall_time_s']:.1f}s {record['error']}", flush=True)
+            records.append(record)
+
+    manifest = pd.DataFrame(records, columns=['Patient ID', 'status', 'wall_time_s', 'error'])
+    manifest.to_csv(f'{path}/data/hr_values/run_manifest.csv', index=False)
+    return manifest
+
+
+if __name__ == '__main__':
+    #read in signal freq -> dictionary
+    file = open(f"{path}/data/label_freq.txt", 'r')
+    label_freq = file.read()
+    label_freq = eval(label_freq)
+    file.close()
+
+    ecg_fs = label_freq['ECG_A']
+
+    #open the data file to loop through
+    df = pd.read_excel(f"{path}/data/data_files.xlsx")
+
+    run_cohort(df, ecg_fs)
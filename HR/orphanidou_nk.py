@@ -3,6 +3,11 @@ import numpy as np
 import matplotlib.pyplot as plt
 import neurokit2 as nk
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 from ecgdetectors import Detectors
 import neurokit2 as nk
 
@@ -20,8 +25,11 @@ def filter_ecg(x, fs):
     cutoff_frequency = (low_cutoff, high_cutoff)
     b, a = signal.butter(order, cutoff_frequency, btype='band', fs=fs)
     # b, a = signal.butter(3, [0.004, 0.06], 'band')    # original 
+    # filtfilt runs along the last axis so a (n_windows, n_samples) matrix is filtered in one call
     sig = signal.filtfilt(b, a, sig, padlen=150)
-    sig = (sig - min(sig)) / (max(sig) - min(sig))
+    sig_min = sig.min(axis=-1, keepdims=True)
+    sig_max = sig.max(axis=-1, keepdims=True)
+    sig = (sig - sig_min) / (sig_max - sig_min)
     return sig
 
 def detect_beats(sig, fs):
@@ -39,7 +47,7 @@ def find_rr_ints(beats,fs):
     return rr_int
 
 
-def assess_feasibility(beats):
+def assess_feasibility(beats, fs):
     
     feas = 1
     
@@ -78,29 +86,105 @@ def assess_feasibility(beats):
 
 
 
-def calculate_template(sig, beats):
+def beat_wave_starts(beats, tol):
+
+    # first sample of the window of each beat (excluding the last) that lies between 0 and the last beat
+    starts = np.asarray(beats[:-1], dtype=np.int64) - tol
+    starts = starts[(starts >= 0) & (starts + 2*tol <= beats[-1])]
+    return starts
+
+
+def gather_beat_waves(sig, beats, tol):
+
+    # gather one row of 1+2*tol samples per beat
+    starts = beat_wave_starts(beats, tol)
+    idx = starts[:, None] + np.arange(1 + 2*tol)
+    waves = np.asarray(sig, dtype=float)[idx]
+    return waves
+
+
+def calculate_beat_ccs(waves, templ):
+
+    # Pearson coefficient of every beat against the template, following the steps of np.corrcoef
+    fact = waves.shape[1] - 1
+    waves_c = waves - waves.mean(axis=1, keepdims=True)
+    templ_c = templ - templ.mean()
+    cov = np.dot(waves_c, templ_c) * np.true_divide(1, fact)
+    std_waves = np.sqrt(np.einsum('ij,ij->i', waves_c, waves_c) * np.true_divide(1, fact))
+    std_templ = np.sqrt(np.dot(templ_c, templ_c) * np.true_divide(1, fact))
+    ccs = cov / std_waves / std_templ
+    ccs = np.clip(ccs, -1, 1)
+    return ccs
+
+
+def _sum_beat_waves_loop(sig, starts, width):
+
+    # sum of the beat windows, adding the beats in order
+    sum_waves = np.zeros(width)
+    for start in starts:
+        for i in range(width):
+            sum_waves[i] += sig[start + i]
+    return sum_waves
+
+
+def _beat_ccs_loop(sig, starts, width, templ):
+
+    # Pearson coefficient of every beat against the template, one beat at a time without temporary arrays
+    fact = width - 1
+    templ_mean = 0.0
+    for i in range(width):
+        templ_mean += templ[i]
+    templ_mean /= width
+    templ_ss = 0.0
+    for i in range(width):
+        templ_ss += (templ[i] - templ_mean) ** 2
+    std_templ = np.sqrt(templ_ss / fact)
+
+    ccs = np.zeros(len(starts))
+    for b in range(len(starts)):
+        start = starts[b]
+        wave_mean = 0.0
+        for i in range(width):
+            wave_mean += sig[start + i]
+        wave_mean /= width
+        cov = 0.0
+        wave_ss = 0.0
+        for i in range(width):
+            wave_c = sig[start + i] - wave_mean
+            cov += wave_c * (templ[i] - templ_mean)
+            wave_ss += wave_c * wave_c
+        cc = (cov / fact) / np.sqrt(wave_ss / fact) / std_templ
+        ccs[b] = min(max(cc, -1.0), 1.0)
+    return ccs
+
+
+if njit is not None:
+    _sum_beat_waves_loop = njit(_sum_beat_waves_loop)
+    _beat_ccs_loop = njit(_beat_ccs_loop)
+
+
+def calculate_template(sig, beats, use_numba=False):
     
     # find median rr interval
     med_rr_int = calculate_med_rr_int(beats)
     
     # find no. samples either side of beat
     tol = int(np.floor(med_rr_int/2))
-    sum_waves = np.zeros(1+2*tol)
-    no_beats_used = 0
-    for beat_no in range(0,len(beats)-1):
-            min_el = beats[beat_no]-tol
-            max_el = beats[beat_no]+tol
-            if min_el < 0 or max_el > beats[-1]:
-                continue
-            curr_samps = sig[min_el:max_el+1]
-            for i in range(0,len(sum_waves)):
-                sum_waves[i] += curr_samps[i]
-            no_beats_used +=1
+
+    # average the beat windows; with no usable beat this gives NaNs, as the loop over beats did
+    if use_numba and njit is not None:
+        starts = beat_wave_starts(beats, tol)
+        sum_waves = _sum_beat_waves_loop(np.asarray(sig, dtype=float), starts, 1 + 2*tol)
+        no_beats_used = len(starts)
+    else:
+        waves = gather_beat_waves(sig, beats, tol)
+        sum_waves = waves.sum(axis=0)
+        no_beats_used = len(waves)
     templ = sum_waves/no_beats_used
     return templ
 
 
-def calculate_cc(sig, beats, templ):
+def calculate_cc(sig, beats, templ, use_numba=False):
     
     # find median rr interval
     med_rr_int = calculate_med_rr_int(beats)
@@ -109,22 +193,15 @@ def calculate_cc(sig, beats, templ):
     tol = int(np.floor(med_rr_int/2))
     
     # calculate correlation coefficients for each beat
-    sum_cc = 0
-    no_beats_used = 0
-    for beat_no in range(0,len(beats)-1):
-            min_el = beats[beat_no]-tol
-            max_el = beats[beat_no]+tol
-            if min_el < 0 or max_el > beats[-1]:
-                continue
-            curr_samps = np.zeros(1+2*tol)
-            for i in range(0, 1+2*tol):
-                curr_samps[i] += sig[min_el+i]
-            temp = np.corrcoef(curr_samps, templ)
-            curr_cc = temp[0,1]
-            sum_cc = np.add(sum_cc, curr_cc)
-            no_beats_used +=1
-            
-    # find average correlation coefficient
+    if use_numba and njit is not None:
+        ccs = _beat_ccs_loop(np.asarray(sig, dtype=float), beat_wave_starts(beats, tol), 1 + 2*tol, np.asarray(templ, dtype=float))
+    else:
+        ccs = calculate_beat_ccs(gather_beat_waves(sig, beats, tol), templ)
+
+    # find average correlation coefficient, summing in beat order; with no usable beat this raises
+    # ZeroDivisionError, as the loop over beats did
+    sum_cc = np.cumsum(ccs)[-1] if len(ccs) else 0
+    no_beats_used = len(ccs)
     cc = sum_cc/no_beats_used
     return cc
 
@@ -157,7 +234,7 @@ def assess_qual(x, fs, thresh):
     beats = detect_beats(sig, fs)
     
     # assess feasibility of beat detections
-    feas = assess_feasibility(beats)
+    feas = assess_feasibility(beats, fs)
     if feas == 0:
         qual = 0
         return qual
@@ -185,7 +262,7 @@ def assess_qual_hr(x, fs, thresh):
 
     
     # assess feasibility of beat detections
-    feas = assess_feasibility(beats)
+    feas = assess_feasibility(beats, fs)
     #print(feas)
     if feas == 0:
         qual = 0
@@ -208,5 +285,56 @@ def assess_qual_hr(x, fs, thresh):
     
 
     return qual, hr_full, beats
-   
-    
\ No newline at end of file
+
+
+def assess_qual_hr_batch(ecg_matrix, fs, thresh, chunk_size=4096):
+    """
+    Batch version of assess_qual_hr for a (n_windows, n_samples) matrix of ECG windows.
+
+    Windows are filtered chunk_size rows at a time with a single filtfilt call, and the
+    template and correlation steps use gathered beat matrices instead of per-sample loops.
+    A window with no beat far enough from the edges to build a template is given a
+    quality and HR of 0 instead of raising ZeroDivisionError.
+
+    Returns:
+    - quality: int array of quality flags (1 = acceptable) per window.
+    - hr: float array of HR values in bpm per window (0 for unacceptable windows).
+    - beats: list with the detected beat locations (list of ints) for each window.
+    """
+    ecg_matrix = np.atleast_2d(ecg_matrix)
+    n_windows = ecg_matrix.shape[0]
+
+    quality = np.zeros(n_windows, dtype=int)
+    hr = np.zeros(n_windows)
+    beats_all = []
+
+    for chunk_start in range(0, n_windows, chunk_size):
+        # filter the whole chunk of windows at once
+        sigs = filter_ecg(ecg_matrix[chunk_start:chunk_start + chunk_size], fs)
+
+        for row, sig in enumerate(sigs):
+            i = chunk_start + row
+            x = ecg_matrix[i]
+
+            # detect beats and assess their feasibility
+            beats = detect_beats(sig, fs)
+            beats_all.append(beats)
+            if assess_feasibility(beats, fs) == 0:
+                continue
+
+            # build the template from the gathered beats
+            tol = int(np.floor(calculate_med_rr_int(beats)/2))
+            waves = gather_beat_waves(x, beats, tol)
+            if len(waves) == 0:
+                continue
+            templ = waves.sum(axis=0)/len(waves)
+
+            # average the correlation coefficients, summing in beat order as calculate_cc does
+            ccs = calculate_beat_ccs(waves, templ)
+            cc = np.cumsum(ccs)[-1]/len(ccs)
+
+            quality[i] = compare_cc_to_thresh(cc, thresh)
+            if quality[i] == 1:
+                hr[i] = 60*len(beats)/((beats[-1]-beats[0])/fs)
+
+    return quality, hr, beats_all
@@ -1,130 +1,211 @@
 
 import numpy as np
 import os
+import gzip
 import matplotlib.pyplot as plt
 import scipy 
 import pandas as pd
 import polars as pl
 import pytz
-from datetime import timedelta
+from datetime import datetime, timedelta
 
 path = '../../data/'
 
 
-def reformat_acc(patient_id, file_name, start_time, fs=25):
+def format_acc_time(utc_times, tz='Europe/London'):
     """
-    Function that reads in the raw acceleration data from the parquet files and reformats it into a dataframe with the 
-    following columns: 'timestamp', 'x', 'y', 'z, temp'. The timestamp is in seconds and the acceleration values are in m/s^2.
+    Format UTC times as "YYYY-MM-DD HH:MM:SS.sss+zzzz [tz]" strings with vectorised operations.
+
+    Args:
+    - utc_times: datetime64 array of UTC times.
+    - tz: the time zone to show the times in. Default is 'Europe/London'.
+
+    Returns:
+    - time_strings: numpy array of formatted time strings.
+    """
+    utc_times = pd.DatetimeIndex(utc_times).tz_localize('UTC')
+    local_times = utc_times.tz_convert(tz).tz_localize(None)
+
+    #wall-clock time to millisecond precision, with the 'T' separator swapped for a space in place
+    wall = np.datetime_as_string(local_times.to_numpy(), unit='ms').astype('U23')
+    wall.view('U1').reshape(-1, 23)[:, 10] = ' '
+
+    #there are only a few distinct offsets, so format each one once and look them up
+    offset_minutes = ((local_times - utc_times.tz_localize(None)) // pd.Timedelta(minutes=1)).to_numpy()
+    unique_offsets, inverse = np.unique(offset_minutes, return_inverse=True)
+    offset_strings = np.array([f"{'+' if m >= 0 else '-'}{abs(m) // 60:02d}{abs(m) % 60:02d} [{tz}]" for m in unique_offsets])
+
+    return np.char.add(wall, offset_strings[inverse])
+
+
+def reformat_acc(patient_id, file_name, start_time, fs=25, compress=False, chunk_size=1_000_000):
+    """
+    Function that reads in the raw acceleration data from the parquet files and reformats it into a CSV file with the 
+    following columns: 'time', 'x', 'y', 'z', 'temp', as read by accProcess. The acceleration values are in m/s^2.
+
+    Timestamps are computed with integer arithmetic on the whole recording and the CSV is written chunk_size
+    rows at a time, so only one chunk of formatted rows is held in memory.
     
     Args:
     - patient_id: the patient ID of the patient whose data is to be reformatted.
+    - file_name: the name of the folder holding the patient's parquet files.
+    - start_time: the start time of the recording in Europe/London local time.
     - fs: the sampling frequency of the data. Default is 25 Hz.
+    - compress: whether to write a gzip compressed .csv.gz file instead of a plain .csv. Default is False.
+    - chunk_size: number of rows formatted and written at a time. Default is 1,000,000.
     
     Returns:
-    - df: a dataframe containing the reformatted acceleration data.
+    - output_file: path of the CSV file written.
     """
     
     
     #load in the parquet file for x, y and z
-    x = pl.read_parquet(path + f"bdf_files/{file_name}/{patient_id}/ACC_X.parquet")
-    y = pl.read_parquet(path + f"bdf_files/{file_name}/{patient_id}/ACC_Y.parquet")
-    z = pl.read_parquet(path + f"bdf_files/{file_name}/{patient_id}/ACC_Z.parquet")
-
-    # Convert to pandas DataFrame
-    df_x = x.to_pandas()
-    df_y = y.to_pandas()
-    df_z = z.to_pandas()
-
-    # Combine df_x, df_y, df_z into a single dataframe
-    df_combined = pd.DataFrame({
-        'x' : df_x.values.flatten(),
-        'y' : df_y.values.flatten(),
-        'z' : df_z.values.flatten()
-    })
-
-    #convert time into a timezone aware datetime object
+    x = pl.read_parquet(path + f"bdf_files/{file_name}/{patient_id}/ACC_X.parquet").to_series().to_numpy()
+    y = pl.read_parquet(path + f"bdf_files/{file_name}/{patient_id}/ACC_Y.parquet").to_series().to_numpy()
+    z = pl.read_parquet(path + f"bdf_files/{file_name}/{patient_id}/ACC_Z.parquet").to_series().to_numpy()
+
+    #convert time into a timezone aware datetime object, then to UTC nanoseconds since the epoch
     start_time = pd.to_datetime(start_time).tz_localize('Europe/London')
+    start_ns = start_time.tz_convert('UTC').tz_localize(None).to_datetime64().astype('datetime64[ns]').astype(np.int64)
 
-    # Generate the time column with 25 Hz frequency (1 sample every 40 milliseconds)
-    time_stamps = [start_time + timedelta(seconds=i / 25) for i in range(len(df_combined))]
+    #save to csv file to nobackup
+    output_file = path + f"bdf_files/{file_name}/{patient_id}/{patient_id}_combined.csv"
+    if compress:
+        output_file += '.gz'
+
+    # Save to CSV one chunk at a time, with the header written by the first chunk only
+    with (gzip.open(output_file, 'wt', newline='') if compress else open(output_file, 'w', newline='')) as f:
+        for chunk_start in range(0, len(x), chunk_size):
+            chunk = slice(chunk_start, chunk_start + chunk_size)
+
+            # Generate the time column with fs Hz frequency (1 sample every 40 milliseconds at 25 Hz)
+            sample_idx = np.arange(chunk_start, chunk_start + len(x[chunk]), dtype=np.int64)
+            offsets_us = np.round(sample_idx / fs * 1e6).astype(np.int64)
+            utc_times = (start_ns + offsets_us * 1000).astype('datetime64[ns]')
+
+            # Convert to the required time format "YYYY-MM-DD HH:MM:SS.sss+zzzz [Europe/London]"
+            df_chunk = pd.DataFrame({
+                'time' : format_acc_time(utc_times),
+                'x' : x[chunk],
+                'y' : y[chunk],
+                'z' : z[chunk],
+                'temp' : 0.0 # Add a temperature column with placeholder values (zeros)
+            })
+
+            df_chunk.to_csv(f, index=False, header=(chunk_start == 0))
 
-    # Convert to the required time format "YYYY-MM-DD HH:MM:SS.sss+zzzz [Europe/London]"
-    df_combined['time'] = [ts.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3] + ts.strftime('%z') + ' [Europe/London]' for ts in time_stamps]
+    print(f"CSV file for {patient_id} created")
 
-    # Move the 'time' column to the first position
-    df_combined = df_combined[['time', 'x', 'y', 'z']]
+    return output_file
 
-    # Assuming df_combined is your pandas dataframe with time, x, y, z
-    df_combined['temp'] = 0.0  # Add a temperature column with placeholder values (zeros)
+#naive reference point for converting wall-clock times to integer microseconds
+EPOCH = datetime(1970, 1, 1)
 
-    # Reorder columns to match the expected order: time, x, y, z, temp
-    df_combined = df_combined[['time', 'x', 'y', 'z', 'temp']]
 
-    #save to csv file to nobackup
-    output_file = path + f"bdf_files/{file_name}/{patient_id}/{patient_id}_combined.csv"
+def utc_offsets(wall_seconds, tzinfo):
+    """
+    Return the UTC offset in seconds of each wall-clock second, as used by datetime.timestamp().
 
-    # Save to CSV
-    df_combined.to_csv(output_file, index=False)
+    Args:
+    - wall_seconds: sorted int64 array of wall-clock seconds since 1970-01-01.
+    - tzinfo: the time zone of the wall-clock times, or None for the machine's local time (naive datetimes).
 
-    print(f"CSV file for {patient_id} created")
+    Returns:
+    - offsets: int64 array with one offset per element of wall_seconds.
+    """
+    def offset(sec):
+        wall = EPOCH + timedelta(seconds=int(sec))
+        if tzinfo is None:
+            return int(sec) - int(wall.timestamp())
+        return int(wall.replace(tzinfo=tzinfo).utcoffset().total_seconds())
 
-def save_to_csv2(acc_x, acc_y, acc_z, start_time, output_dir, patient_id):
-    sampling_frequency = 25
-    samples_per_day = 24 * 60 * 60 * sampling_frequency
-    min_samples_per_day = 1 * sampling_frequency
+    #blocks are at most a day long, so an unchanged offset at both ends means no DST change in between
+    first, last = offset(wall_seconds[0]), offset(wall_seconds[-1])
+    if first == last:
+        return np.full(len(wall_seconds), first, dtype=np.int64)
 
-    total_samples = len(acc_x)
-    total_days = total_samples // samples_per_day
-    remaining_samples = total_samples % samples_per_day
+    unique_seconds, inverse = np.unique(wall_seconds, return_inverse=True)
+    return np.array([offset(sec) for sec in unique_seconds], dtype=np.int64)[inverse]
 
-    #extract the numeric part of the patient ID
-    numeric_patient_id = patient_id.lstrip('R')
-    numeric_patient_id = int(numeric_patient_id)
-    numeric_patient_id = str(numeric_patient_id)    
 
-    def format_data(arr1, arr2, arr3, start_time, sampling_rate=25):
-        timestamps = []
-        utc_times = []
-        accuracy = np.full(len(arr1), 'unknown')
-        
-        current_time = start_time
-        for i in range(len(arr1)):
-            timestamps.append(int(current_time.timestamp() * 1000))
-            utc_times.append(current_time.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3])
-            current_time += timedelta(seconds=1/sampling_rate)
-        
-        formatted_data = np.column_stack((timestamps, utc_times, accuracy, arr1, arr2, arr3))
-        formatted_data = [f"{row[0]},{row[1]},{row[2]},{row[3]},{row[4]},{row[5]}" for row in formatted_data]
-        
-        # Add column titles
-        column_titles = "timestamp,UTC time,accuracy,x,y,z"
-        formatted_data.insert(0, column_titles)
-        
-        return "\n".join(formatted_data)
+def acc_timestamps(start_time, first_sample, n_samples, sampling_rate=25):
+    """
+    Compute the epoch-ms timestamps and wall-clock times of consecutive samples with integer arithmetic.
 
-    for day in range(total_days):
-        start_idx = day * samples_per_day
-        end_idx = start_idx + samples_per_day
+    The values match stepping a datetime from start_time by timedelta(seconds=1/sampling_rate) and taking
+    int(t.timestamp() * 1000) for each sample, including the float truncation of timestamp().
 
-        start_time_str = (start_time + timedelta(days=day)).strftime('%Y-%m-%d %H_%M_%S')
-        csv_data = format_data(acc_x[start_idx:end_idx], acc_y[start_idx:end_idx], acc_z[start_idx:end_idx], start_time + timedelta(days=day))
+    Args:
+    - start_time: datetime of the first sample of the recording (naive times are in the machine's local time).
+    - first_sample: index of the first sample to compute.
+    - n_samples: number of samples to compute.
+    - sampling_rate: the sampling frequency of the data. Default is 25 Hz.
 
-        file_path = os.path.join(output_dir, numeric_patient_id, 'accelerometer', f"{start_time_str}.csv")
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    Returns:
+    - timestamps: int64 array of epoch milliseconds.
+    - wall_times: datetime64[us] array of the wall-clock times.
+    """
+    step_us = timedelta(seconds=1 / sampling_rate) // timedelta(microseconds=1)
+    start_us = (start_time.replace(tzinfo=None) - EPOCH) // timedelta(microseconds=1)
+    wall_us = start_us + (first_sample + np.arange(n_samples, dtype=np.int64)) * step_us
 
-        with open(file_path, 'w') as f:
-            f.write(csv_data)
+    wall_seconds, micro = np.divmod(wall_us, 1_000_000)
+    offsets = utc_offsets(wall_seconds, start_time.tzinfo)
+    if start_time.tzinfo is None:
+        #naive datetime.timestamp() adds the microseconds to the whole local seconds
+        seconds = (wall_seconds - offsets).astype(np.float64) + micro / 1e6
+    else:
+        #aware datetime.timestamp() divides the total microseconds since the epoch
+        seconds = (wall_us - offsets * 1_000_000) / 1e6
 
-    if remaining_samples >= min_samples_per_day:
-        start_idx = total_days * samples_per_day
-        start_time_str = (start_time + timedelta(days=total_days)).strftime('%Y-%m-%d %H_%M_%S')
-        csv_data = format_data(acc_x[start_idx:], acc_y[start_idx:], acc_z[start_idx:], start_time + timedelta(days=total_days))
+    timestamps = (seconds * 1000).astype(np.int64)
+    return timestamps, wall_us.astype('datetime64[us]')
 
-        file_path = os.path.join(output_dir, numeric_patient_id, 'accelerometer', f"{start_time_str}.csv")
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
 
-        with open(file_path, 'w') as f:
-            f.write(csv_data)
+def write_acc_csv(file_path, acc_x, acc_y, acc_z, start_time, first_sample=0, sampling_rate=25, block_size=250_000):
+    """
+    Write accelerometer samples to a CSV file in the format read by the forest oak step counter.
+
+    Rows are formatted with vectorised string operations and written block_size samples at a time, so the
+    whole file is never held in memory as one string.
+
+    Args:
+    - file_path: path of the CSV file to write.
+    - acc_x, acc_y, acc_z: X, Y, Z axis accelerometer data for the file.
+    - start_time: datetime of the first sample of the recording.
+    - first_sample: index of acc_x[0] within the recording. Default is 0.
+    - sampling_rate: the sampling frequency of the data. Default is 25 Hz.
+    - block_size: number of samples formatted and written at a time.
+    """
+    acc_x, acc_y, acc_z = np.asarray(acc_x), np.asarray(acc_y), np.asarray(acc_z)
+
+    with open(file_path, 'w') as f:
+        # Column titles, with every row starting on a new line and no newline at the end of the file
+        f.write("timestamp,UTC time,accuracy,x,y,z")
+        for block_start in range(0, len(acc_x), block_size):
+            block = slice(block_start, block_start + block_size)
+            n_block = len(acc_x[block])
+            timestamps, wall_times = acc_timestamps(start_time, first_sample + block_start, n_block, sampling_rate)
+
+            # Format UTC time strings to millisecond precision and build the rows column by column
+            rows = np.char.add(timestamps.astype(str), ',')
+            rows = np.char.add(rows, np.datetime_as_string(wall_times, unit='ms'))
+            rows = np.char.add(rows, ',unknown,')
+            rows = np.char.add(rows, acc_x[block].astype(str))
+            rows = np.char.add(rows, ',')
+            rows = np.char.add(rows, acc_y[block].astype(str))
+            rows = np.char.add(rows, ',')
+            rows = np.char.add(rows, acc_z[block].astype(str))
+
+            f.write("\n")
+            f.write("\n".join(rows.tolist()))
+
+
+def save_to_csv2(acc_x, acc_y, acc_z, start_time, output_dir, patient_id):
+    """
+    Alias of save_to_csv kept for older scripts.
+    """
+    save_to_csv(acc_x, acc_y, acc_z, start_time, output_dir, patient_id)
 
 def save_to_csv(acc_x, acc_y, acc_z, start_time, output_dir, patient_id):
     """
@@ -154,43 +235,6 @@ def save_to_csv(acc_x, acc_y, acc_z, start_time, output_dir, patient_id):
     numeric_patient_id = int(numeric_patient_id)
     numeric_patient_id = str(numeric_patient_id)    
 
-    def format_data(arr1, arr2, arr3, start_time, sampling_rate=25):
-        """
-        Formats data into CSV-ready rows with timestamps and UTC times.
-
-        Parameters:
-            arr1, arr2, arr3 (list): Data for each axis (x, y, z).
-            start_time (datetime): Timestamp for start of data.
-            sampling_rate (int): Frequency at which data was sampled.
-        
-        Returns:
-            str: Formatted CSV string with timestamps, UTC times, and accelerometer data.
-        """
-        
-        # Prepare timestamps and UTC times
-        timestamps = []
-        utc_times = []
-        accuracy = np.full(len(arr1), 'unknown')  # Placeholder for accuracy data
-        
-        current_time = start_time
-        for i in range(len(arr1)):
-            # Convert timestamp to milliseconds
-            timestamps.append(int(current_time.timestamp() * 1000))
-            # Format UTC time string to millisecond precision
-            utc_times.append(current_time.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3])
-            # Increment time by sampling interval
-            current_time += timedelta(seconds=1 / sampling_rate)
-        
-        # Stack data into columns and format as strings
-        formatted_data = np.column_stack((timestamps, utc_times, accuracy, arr1, arr2, arr3))
-        formatted_data = [f"{row[0]},{row[1]},{row[2]},{row[3]},{row[4]},{row[5]}" for row in formatted_data]
-        
-        # Add column headers to the CSV output
-        column_titles = "timestamp,UTC time,accuracy,x,y,z"
-        formatted_data.insert(0, column_titles)
-        
-        return "\n".join(formatted_data)
-
     # Process each full day of data and save to individual CSV files
     for day in range(total_days):
         start_idx = day * samples_per_day
@@ -198,36 +242,38 @@ def save_to_csv(acc_x, acc_y, acc_z, start_time, output_dir, patient_id):
 
         # Generate filename with start time for each day's data
         start_time_str = (start_time + timedelta(days=day)).strftime('%Y-%m-%d %H_%M_%S')
-        csv_data = format_data(
-            acc_x[start_idx:end_idx],
-            acc_y[start_idx:end_idx],
-            acc_z[start_idx:end_idx],
-            start_time + timedelta(days=day)
-        )
 
         # Define file path and ensure directory exists
         file_path = os.path.join(output_dir, numeric_patient_id, 'accelerometer', f"{start_time_str}.csv")
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
 
         # Write formatted data to CSV file
-        with open(file_path, 'w') as f:
-            f.write(csv_data)
+        write_acc_csv(
+            file_path,
+            acc_x[start_idx:end_idx],
+            acc_y[start_idx:end_idx],
+            acc_z[start_idx:end_idx],
+            start_time,
+            first_sample=start_idx,
+            sampling_rate=sampling_frequency
+        )
 
     # Save any remaining data if it meets the minimum sample threshold
     if remaining_samples >= min_samples_per_day:
         start_idx = total_days * samples_per_day
         start_time_str = (start_time + timedelta(days=total_days)).strftime('%Y-%m-%d %H_%M_%S')
-        csv_data = format_data(
-            acc_x[start_idx:],
-            acc_y[start_idx:],
-            acc_z[start_idx:],
-            start_time + timedelta(days=total_days)
-        )
 
         # Define file path and ensure directory exists
         file_path = os.path.join(output_dir, numeric_patient_id, 'accelerometer', f"{start_time_str}.csv")
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
 
         # Write formatted data to CSV file
-        with open(file_path, 'w') as f:
-            f.write(csv_data)
\ No newline at end of file
+        write_acc_csv(
+            file_path,
+            acc_x[start_idx:],
+            acc_y[start_idx:],
+            acc_z[start_idx:],
+            start_time,
+            first_sample=start_idx,
+            sampling_rate=sampling_frequency
+        )
\ No newline at end of file
@@ -1,46 +1,133 @@
 
 import numpy as np
 import os
+import time
+import multiprocessing
 import matplotlib.pyplot as plt
-import scipy 
+import scipy
 import pandas as pd
 import polars as pl
 import pytz
 from datetime import timedelta
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from altering_format import reformat_acc
 
 #set path to REMOTES folder
 path = '../../data'
 
-#open dataframe with file names & start times
-df = pd.read_excel(path + '/data_labels.xlsx')
+#folder the accProcess outputs are collected in
+output_dir = os.path.join(path + "/activity_class")
 
-#loop through the dataframe, extract the Patient ID values, reformat the data save to new csv file, and run the accProcess program
-for index, row in df.iloc[5:6].iterrows():
-    
-    patient_id = row['Patient ID']
-    file_name = df[df['Patient ID'] == patient_id]['file_name'].values[0]
-    start_time = df[df['Patient ID'] == patient_id]['Start'].values[0]
-    
 
-    #reformat the data into the csv file needed
-    print(f"Reformatting data for patient {patient_id}...")
-    reformat_acc(patient_id, file_name, start_time)
+def run_reformat(patient_id, file_name, start_time):
+    """
+    Worker wrapper around reformat_acc that records the wall time and any failure instead of raising.
+    """
+    start = time.perf_counter()
+    try:
+        reformat_path = reformat_acc(patient_id, file_name, start_time)
+        status, error = 'reformatted', ''
+    except Exception as e:
+        reformat_path, status, error = None, 'failed', repr(e)
+    return {'Patient ID': patient_id, 'file_name': file_name, 'reformat_path': reformat_path, 'status': status,
+            'reformat_s': time.perf_counter() - start, 'error': error}
 
-    # Identify the path of the new csv file
-    reformat_path = os.path.join(path, f"bdf_files/{file_name}/{patient_id}/{patient_id}_combined.csv")
 
-    # Ensure the destination directory exists
-    output_dir = os.path.join(path + "/activity_class")
-    os.makedirs(output_dir, exist_ok=True)
-    
+def run_acc_process(record, sample_rate=25):
+    """
+    Run accProcess on a reformatted CSV and move its two output files to output_dir.
+
+    Args:
+    - record: the record returned by run_reformat, which is updated with the status and accProcess wall time.
+    - sample_rate: the sampling frequency of the CSV. Default is 25 Hz.
+
+    Returns:
+    - record: the updated record.
+    """
+    patient_id, file_name = record['Patient ID'], record['file_name']
+    start = time.perf_counter()
+
     # Run the accProcess without redirecting output because it generates two files automatically
-    subprocess.run(["accProcess", reformat_path, "--sampleRate",  "25"])
+    try:
+        result = subprocess.run(["accProcess", record['reformat_path'], "--sampleRate", str(sample_rate)])
+    except OSError as e:
+        record['acc_process_s'] = time.perf_counter() - start
+        record['status'], record['error'] = 'failed', repr(e)
+        return record
+
+    record['acc_process_s'] = time.perf_counter() - start
+    if result.returncode != 0:
+        record['status'], record['error'] = 'failed', f'accProcess exited with code {result.returncode}'
+        return record
 
     # Move the generated files to the output directory
-    subprocess.run(["mv", path + f"/bdf_files/{file_name}/{patient_id}/{patient_id}_combined-summary.json", f"{output_dir}"])
-    subprocess.run(["mv", path + f"/bdf_files/{file_name}/{patient_id}/{patient_id}_combined-timeSeries.csv.gz", f"{output_dir}"])
+    try:
+        for suffix in ['summary.json', 'timeSeries.csv.gz']:
+            output_name = f"{patient_id}_combined-{suffix}"
+            os.replace(os.path.join(path, f"bdf_files/{file_name}/{patient_id}/{output_name}"), os.path.join(output_dir, output_name))
+        record['status'] = 'done'
+    except OSError as e:
+        record['status'], record['error'] = 'failed', repr(e)
+    return record
+
+
+def run_cohort(df, n_reformat_workers=2, n_acc_workers=2):
+    """
+    Reformat the accelerometer data and run accProcess for every patient in df.
+
+    Reformatting runs in a pool of worker processes. As soon as a patient's CSV is written it is handed to a
+    separate pool of accProcess subprocesses, so reformatting of the next patients overlaps with accProcess of
+    the previous ones. Patients whose timeSeries.csv.gz is already in output_dir are skipped.
+
+    Args:
+    - df: dataframe with 'Patient ID', 'file_name' and 'Start' columns.
+    - n_reformat_workers: number of reformatting processes. Default is 2.
+    - n_acc_workers: number of concurrent accProcess subprocesses. Default is 2.
+
+    Returns:
+    - log: dataframe with the status, stage wall times and error message of each patient.
+    """
+    # Ensure the destination directory exists
+    os.makedirs(output_dir, exist_ok=True)
+
+    records = []
+    pending = []
+    for patient_id, file_name, start_time in zip(df['Patient ID'], df['file_name'], df['Start']):
+        if os.path.exists(os.path.join(output_dir, f"{patient_id}_combined-timeSeries.csv.gz")):
+            records.append({'Patient ID': patient_id, 'file_name': file_name, 'status': 'skipped'})
+        else:
+            pending.append((patient_id, file_name, start_time))
+
+    print(f"{len(pending)} patients to process, {len(records)} skipped", flush=True)
+
+    #spawn fresh workers as forking after polars has started its thread pool can deadlock
+    with ProcessPoolExecutor(max_workers=n_reformat_workers, mp_context=multiprocessing.get_context('spawn')) as reformat_pool, \
+         ThreadPoolExecutor(max_workers=n_acc_workers) as acc_pool:
+        reformat_futures = [reformat_pool.submit(run_reformat, *patient) for patient in pending]
+
+        acc_futures = []
+        for future in as_completed(reformat_futures):
+            record = future.result()
+            print(f"{record['Patient ID']}: {record['status']} in {record['reformat_s']:.1f}s {record['error']}", flush=True)
+            if record['status'] == 'failed':
+                records.append(record)
+            else:
+                acc_futures.append(acc_pool.submit(run_acc_process, record))
+
+        for future in as_completed(acc_futures):
+            record = future.result()
+            print(f"{record['Patient ID']}: {record['status']} after accProcess in {record['acc_process_s']:.1f}s {record['error']}", flush=True)
+            records.append(record)
+
+    log = pd.DataFrame(records, columns=['Patient ID', 'status', 'reformat_s', 'acc_process_s', 'error'])
+    log.to_csv(os.path.join(output_dir, 'run_log.csv'), index=False)
+    return log
+
 
-    
+if __name__ == '__main__':
+    #open dataframe with file names & start times
+    df = pd.read_excel(path + '/data_labels.xlsx')
 
+    #reformat the data, run accProcess and collect the outputs for every patient
+    run_cohort(df)
@@ -1,11 +1,15 @@
 import numpy as np
 import os
+import time
+import shutil
+import multiprocessing
 
 from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from forest.oak.base import run
 from forest.constants import Frequency
 
-import scipy 
+import scipy
 import pandas as pd
 import polars as pl
 import pytz
@@ -14,75 +18,122 @@ import subprocess
 
 from altering_format import save_to_csv
 
-print('READING DATA LABELS FILE',flush=True)
-
 #set path to REMOTES folder
 path = '../../data'
 
+study_folder = f"{path}/steps/input"
+output_folder = f"{path}/steps/results"
 
-
-#open dataframe with file names & start times
-df = pd.read_excel(path + '/data_labels.xlsx')
-
+tz_str = 'Europe/London'
 
 
+def count_patient_steps(patient_id, file_name, start_time, delete_csv=False):
+    """
+    Export the daily accelerometer CSVs of one patient and run the forest oak step counter on them.
 
-print('starting_loop')
-for index, row in df.iterrows():
+    oak writes to a results folder of its own for each patient, so concurrent patients never write to the same
+    folder, and the gait file is then moved to {output_folder}/minute.
 
-    patient_id = row['Patient ID']
-    file_name = df[df['Patient ID'] == patient_id]['file_name'].values[0]
-    start_time = df[df['Patient ID'] == patient_id]['Start'].values[0]
-
-    #reformat the data into the csv file needed
-    print(f"Processing Patient ID: {patient_id}, File Name: {file_name}",flush=True)
+    Args:
+    - patient_id: the patient ID of the recording.
+    - file_name: the name of the folder holding the patient's parquet files.
+    - start_time: the start time of the recording as a '%Y-%m-%d %H:%M:%S' string.
+    - delete_csv: whether to delete the daily CSVs once the step counts have been saved. Default is False.
+    """
     numeric_patient_id = patient_id.lstrip('R')
     numeric_patient_id = int(numeric_patient_id)
     numeric_patient_id = str(numeric_patient_id)
-    print(f"Numeric Patient ID: {numeric_patient_id}",flush=True)
 
     #open the accelerometer data
-    df_accx = pl.read_parquet(f"{path}/bdf_files/{file_name}/{patient_id}/ACC_X.parquet")
-    df_accy = pl.read_parquet(f"{path}/bdf_files/{file_name}/{patient_id}/ACC_Y.parquet")
-    df_accz = pl.read_parquet(f"{path}/bdf_files/{file_name}/{patient_id}/ACC_Z.parquet")
-
-    acc_x = df_accx.to_numpy().reshape(-1)
-    acc_y = df_accy.to_numpy().reshape(-1)
-    acc_z = df_accz.to_numpy().reshape(-1)
+    acc_x = pl.read_parquet(f"{path}/bdf_files/{file_name}/{patient_id}/ACC_X.parquet").to_numpy().reshape(-1)
+    acc_y = pl.read_parquet(f"{path}/bdf_files/{file_name}/{patient_id}/ACC_Y.parquet").to_numpy().reshape(-1)
+    acc_z = pl.read_parquet(f"{path}/bdf_files/{file_name}/{patient_id}/ACC_Z.parquet").to_numpy().reshape(-1)
 
     start_time = datetime.strptime(start_time, '%Y-%m-%d %H:%M:%S')
-    print(f"Start Time: {start_time}",flush=True)
 
-    output_dir = f"{path}/steps/input"
-    save_to_csv(acc_x, acc_y, acc_z, start_time, output_dir, patient_id)
-
-    print(f"CSV file for {patient_id} created",flush=True)
-
-    tz_str = 'Europe/London'
+    #write the daily CSVs read by oak
+    save_to_csv(acc_x, acc_y, acc_z, start_time, study_folder, patient_id)
 
     # Get the start and end time of the signal in this format "2023-01-09 10_32_00"
     time_start = start_time.strftime('%Y-%m-%d %H_%M_%S')
     time_end = (start_time + timedelta(seconds=acc_x.shape[0] / 25)).strftime('%Y-%m-%d %H_%M_%S')
 
-    study_folder = f"{path}/steps/input"
-    output_folder = f"{path}/steps/results"
-
-    frequency = Frequency.MINUTE
-    beiwe_id = [numeric_patient_id]
-
     source_folder = os.path.join(study_folder, numeric_patient_id, "accelerometer")
-    print(source_folder, flush=True)
     if not os.path.exists(source_folder):
-        print(f"Source folder not found for Patient ID: {patient_id}. Skipping.")
-        continue
-
+        raise FileNotFoundError(f"Source folder not found: {source_folder}")
 
-    print(f"Starting run function with beiwe_id: {beiwe_id} and source folder: {source_folder}")
-    run(study_folder, output_folder, tz_str, frequency, time_start, time_end, beiwe_id)
+    patient_output_folder = os.path.join(output_folder, 'patients', numeric_patient_id)
+    run(study_folder, patient_output_folder, tz_str, Frequency.MINUTE, time_start, time_end, [numeric_patient_id])
 
-    
-    results_file = os.path.join(output_folder, 'minute', f'{numeric_patient_id}_gait_hourly.csv')
+    results_file = os.path.join(patient_output_folder, 'minute', f'{numeric_patient_id}_gait_hourly.csv')
     if not os.path.exists(results_file):
-        print(f"Results file not found for Patient ID: {patient_id}. Skipping.")
-        continue
-    
+        raise FileNotFoundError(f"Results file not found: {results_file}")
+
+    os.makedirs(os.path.join(output_folder, 'minute'), exist_ok=True)
+    os.replace(results_file, os.path.join(output_folder, 'minute', f'{numeric_patient_id}_gait_hourly.csv'))
+
+    #the daily CSVs are only needed by oak, so they can be removed once counting has succeeded
+    if delete_csv:
+        shutil.rmtree(os.path.join(study_folder, numeric_patient_id))
+
+
+def run_patient(patient_id, file_name, start_time, delete_csv=False):
+    """
+    Worker wrapper around count_patient_steps that records the wall time and any failure instead of raising.
+    """
+    start = time.perf_counter()
+    try:
+        count_patient_steps(patient_id, file_name, start_time, delete_csv)
+        status, error = 'done', ''
+    except Exception as e:
+        status, error = 'failed', repr(e)
+    return {'Patient ID': patient_id, 'status': status, 'wall_time_s': time.perf_counter() - start, 'error': error}
+
+
+def run_cohort(df, n_workers=None, delete_csv=False):
+    """
+    Count steps for every patient in df with a pool of worker processes.
+
+    Patients whose {id}_gait_hourly.csv is already in {output_folder}/minute are skipped, so an interrupted run
+    can be restarted and only the missing patients are processed.
+
+    Args:
+    - df: dataframe with 'Patient ID', 'file_name' and 'Start' columns.
+    - n_workers: number of worker processes. Default is the number of CPUs.
+    - delete_csv: whether to delete each patient's daily CSVs once their step counts are saved. Default is False.
+
+    Returns:
+    - manifest: dataframe with the status, wall time and error message of each patient.
+    """
+    records = []
+    pending = []
+    for patient_id, file_name, start_time in zip(df['Patient ID'], df['file_name'], df['Start']):
+        numeric_patient_id = str(int(patient_id.lstrip('R')))
+        if os.path.exists(os.path.join(output_folder, 'minute', f'{numeric_patient_id}_gait_hourly.csv')):
+            records.append({'Patient ID': patient_id, 'status': 'skipped', 'wall_time_s': 0.0, 'error': ''})
+        else:
+            pending.append((patient_id, file_name, start_time))
+
+    print(f"{len(pending)} patients to process, {len(records)} skipped", flush=True)
+
+    #spawn fresh workers as forking after polars has started its thread pool can deadlock
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(run_patient, *patient, delete_csv) for patient in pending]
+        for future in as_completed(futures):
+            record = future.result()
+            print(f"{record['Patient ID']}: {record['status']} in {record['wall_time_s']:.1f}s {record['error']}", flush=True)
+            records.append(record)
+
+    manifest = pd.DataFrame(records, columns=['Patient ID', 'status', 'wall_time_s', 'error'])
+    os.makedirs(output_folder, exist_ok=True)
+    manifest.to_csv(os.path.join(output_folder, 'run_manifest.csv'), index=False)
+    return manifest
+
+
+if __name__ == '__main__':
+    print('READING DATA LABELS FILE',flush=True)
+
+    #open dataframe with file names & start times
+    df = pd.read_excel(path + '/data_labels.xlsx')
+
+    run_cohort(df)
@@ -1,9 +1,54 @@
 
+import os
 import pandas as pd
 import numpy as np
 import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
 import time
 import matplotlib.pyplot as plt
+from dataclasses import dataclass
+import neurokit2 as nk
+
+from orphanidou_nk import extract_nn
+from hrv_metrics import HRV_COLUMNS, pad_nn_series, remove_ectopic_beats_batch, interpolate_nan_batch, sliding_window_hrv
+
+
+def downsample_hr(hr, factor, reducer='median', zero_as_missing=True, dtype=np.float32):
+    """
+    Reduce every `factor` consecutive HR values to a single value.
+
+    Args:
+        hr (array-like): HR values, e.g. one every 10 seconds.
+        factor (int): Number of consecutive values reduced to one. A trailing partial chunk is reduced on its own.
+        reducer (str): 'median' or 'mean'.
+        zero_as_missing (bool): If True, zeros are ignored unless the whole chunk is zero. NaNs are always ignored.
+        dtype: dtype of the returned array. Default is float32.
+
+    Returns:
+        numpy array: One value per chunk, 0 for chunks with no valid values.
+    """
+    hr = np.asarray(hr, dtype=np.float64)
+    n_chunks = -(-len(hr) // factor)
+
+    # Pad the trailing partial chunk with NaN and reshape to (n_chunks, factor)
+    chunks = np.full(n_chunks * factor, np.nan)
+    chunks[:len(hr)] = hr
+    chunks = chunks.reshape(n_chunks, factor)
+    if zero_as_missing:
+        chunks[chunks == 0] = np.nan
+
+    # Chunks without any valid value are reduced to 0
+    chunks[np.isnan(chunks).all(axis=1)] = 0
+
+    if reducer == 'median':
+        hr_downsampled = np.nanmedian(chunks, axis=1)
+    elif reducer == 'mean':
+        hr_downsampled = np.nanmean(chunks, axis=1)
+    else:
+        raise ValueError(f"reducer must be 'median' or 'mean', got {reducer!r}")
+
+    return hr_downsampled.astype(dtype)
 
 
 def average_hr_30s(hr_values):
@@ -14,23 +59,9 @@ def average_hr_30s(hr_values):
         hr_values (list): List of HR values, each representing a 10-second period.
     
     Returns:
-        list: Averaged HR values for each 30-second period.
+        numpy array: Median of the non-zero HR values for each 30-second period (0 if all are zero).
     """
-    hr_30s_values = []
-
-    # Process HR values in groups of 3 (each representing 10 seconds)
-    for i in range(0, len(hr_values), 3):
-        group = hr_values[i:i+3]
-
-        # Filter out zero values unless all values are zero
-        non_zero_values = [val for val in group if val != 0]
-
-        if non_zero_values:
-            hr_30s_values.append(np.median(non_zero_values))
-        else:
-            hr_30s_values.append(0)  # Append 0 if all are zero
-
-    return hr_30s_values
+    return downsample_hr(hr_values, 3, reducer='median', dtype=np.float64)
 
 def calculate_sdann_hr24(hr_values, segment_duration):
     """
@@ -60,113 +91,262 @@ def calculate_sdann_hr24(hr_values, segment_duration):
 
     return sdann_hr24
 
-def impute_missing_hr(hr_values, max_gap_duration=60):
+def calculate_sdann_hr24_multiscale(hr_values, segment_durations=(1, 5, 10, 30, 60)):
+    """
+    Calculate SDANN_HR24 for several segment durations from one pass over the HR values.
+
+    The ANN values and their cumulative sums are computed once and every segment mean is taken from the
+    cumulative sum table. Unlike calculate_sdann_hr24, zero and NaN HR values are treated as missing: they are
+    left out of the segment means, and segments with no valid values are left out of the standard deviation.
+
+    Parameters:
+    - hr_values: A list or numpy array of HR values (in bpm) for each minute of a 24-hour period.
+    - segment_durations: The segment durations in minutes.
+
+    Returns:
+    - sdann: Dictionary mapping each segment duration to its SDANN_HR24 value in ms (NaN if no segment is valid).
+    """
+    hr_values = np.asarray(hr_values, dtype=np.float64)
+    valid = np.isfinite(hr_values) & (hr_values != 0)
+
+    # Convert HR values to ANN (Average NN intervals in seconds) and build the cumulative sum tables
+    ann_values = np.zeros(len(hr_values))
+    ann_values[valid] = 60 / hr_values[valid]
+    ann_cumsum = np.concatenate([[0], np.cumsum(ann_values)])
+    count_cumsum = np.concatenate([[0], np.cumsum(valid)])
+
+    sdann = {}
+    for segment_duration in segment_durations:
+        # Segment boundaries, including a trailing partial segment
+        bounds = np.append(np.arange(0, len(hr_values), segment_duration), len(hr_values))
+        segment_sums = ann_cumsum[bounds[1:]] - ann_cumsum[bounds[:-1]]
+        segment_counts = count_cumsum[bounds[1:]] - count_cumsum[bounds[:-1]]
+
+        mean_ann_segments = segment_sums[segment_counts > 0] / segment_counts[segment_counts > 0]
+        if len(mean_ann_segments) == 0:
+            sdann[segment_duration] = np.nan
+        else:
+            sdann[segment_duration] = np.std(mean_ann_segments) * 1000  # Convert to milliseconds
+
+    return sdann
+
+def impute_missing_hr(hr_values, max_gap_duration=60, inplace=False):
     """
     Impute missing HR values (0s) with linear interpolation if the gap is less than max_gap_duration.
 
+    Gaps are found as runs of zeros in a single pass, so the cost does not grow with the number of gaps.
+
     Parameters:
     - hr_values: A numpy array of heart rate values where each element represents a 10-second period.
     - max_gap_duration: Maximum gap duration (in 10s periods) for linear interpolation (default is 60 periods = 10 minutes).
+    - inplace: If True, hr_values must be a float numpy array (e.g. float32) and is filled in place. Default is False.
 
     Returns:
     - hr_values: The numpy array with interpolated values where appropriate.
     """
+    if inplace:
+        hr = hr_values
+    else:
+        hr = np.array(hr_values, dtype=np.float64)
+
+    # Find the start and end (exclusive) of each run of zeros
+    missing = np.concatenate([[False], hr == 0, [False]])
+    edges = np.diff(missing.astype(np.int8))
+    gap_starts = np.flatnonzero(edges == 1)
+    gap_ends = np.flatnonzero(edges == -1)
+
+    # Mark the runs no longer than max_gap_duration, plus any NaNs, for interpolation
+    short = (gap_ends - gap_starts) <= max_gap_duration
+    marker = np.zeros(len(hr) + 1, dtype=np.int64)
+    marker[gap_starts[short]] = 1
+    marker[gap_ends[short]] = -1
+    to_fill = (np.cumsum(marker[:-1]) > 0) | np.isnan(hr)
+
+    fill_idx = np.flatnonzero(to_fill)
+    if len(fill_idx) == 0:
+        return hr
+    valid_idx = np.flatnonzero(~to_fill)
+    if len(valid_idx) == 0:
+        hr[fill_idx] = 0
+        return hr
+
+    # Linear interpolation between valid values, carrying the last value forward at the end
+    # and filling gaps before the first valid value with zeros
+    filled = np.interp(fill_idx, valid_idx, hr[valid_idx])
+    filled[fill_idx < valid_idx[0]] = 0
+    hr[fill_idx] = filled
+
+    return hr
+
+
+
+def parse_acc_time(time_values):
+    """
+    Parse Oxford Biobank time strings such as "2023-01-09 10:32:00.000+0000 [Europe/London]" in one pass.
 
-    # Convert to pandas Series for easy interpolation
-    hr_series = pd.Series(hr_values)
+    Parameters:
+        time_values (Series): Time strings, optionally followed by a bracketed time zone name.
 
-    # Detect where values are zero (assumed to be missing)
-    missing = hr_series == 0
+    Returns:
+        Series: UTC datetime64 timestamps.
+    """
+    cleaned = time_values.str.split(" [", regex=False).str[0]
+    return pd.to_datetime(cleaned, utc=True, format='ISO8601')
 
-    # Create groups of consecutive zeros (missing values)
-    missing_groups = (missing != missing.shift()).cumsum()
-    
-    # Interpolate missing values in groups of zeros less than max_gap_duration
-    for group in missing_groups[missing].unique():
-        group_size = missing_groups[missing_groups == group].size
-        if group_size <= max_gap_duration:  # Only interpolate small gaps
-            hr_series[missing_groups == group] = np.nan
 
-    # Use linear interpolation to fill the gaps
-    hr_series.interpolate(method='linear', inplace=True)
+def read_acc_time_series(file_path, parse_time=True):
+    """
+    Read an Oxford Biobank *_combined-timeSeries.csv.gz file.
 
-    # Fill remaining NaNs (which were not interpolated due to large gaps) with zeros or leave them as NaNs
-    hr_series.fillna(0, inplace=True)
+    Parameters:
+        file_path (str): Path to the timeSeries.csv.gz file.
+        parse_time (bool): If True, convert the 'time' column to UTC datetime64 with parse_acc_time.
 
-    return hr_series.values
+    Returns:
+        DataFrame: Activity classification data with one row every 30 s.
+    """
+    acc_df = pd.read_csv(file_path, compression='gzip')
+    if parse_time:
+        acc_df['time'] = parse_acc_time(acc_df['time'])
+    return acc_df
 
 
+# Oxford Biobank activity class columns stored as int8 in the parquet cache
+ACTIVITY_CLASS_COLUMNS = ['sleep', 'sedentary', 'light', 'moderate-vigorous', 'imputed']
 
-def upsample_acc_df(acc_df):
-    new_rows = []
-    
-    for index, row in acc_df.iterrows():
-        # Get the original time and add two new times at 10 and 20 seconds intervals
-        original_time = pd.to_datetime(row['time'].split(" [")[0])  # Clean the time string
-        
-        for i in range(3):  # For 0s, 10s, and 20s
-            new_row = row.copy()
-            new_time = original_time + pd.Timedelta(seconds=i * 10)
-            new_row['time'] = new_time.strftime('%Y-%m-%d %H:%M:%S.%f%z')
-            new_rows.append(new_row)
-
-    # Create the upsampled dataframe
-    upsampled_df = pd.DataFrame(new_rows)
+
+def load_acc_time_series(file_path, cache_dir=None):
+    """
+    Load an Oxford Biobank *_combined-timeSeries.csv.gz file through a parquet cache.
+
+    The first call parses the gzip CSV with read_acc_time_series and writes a parquet copy with a UTC
+    datetime 'time' column and int8 activity class columns (where the values are whole numbers). Later
+    calls read the parquet copy as long as the source file's mtime and size are unchanged.
+
+    Parameters:
+        file_path (str): Path to the timeSeries.csv.gz file.
+        cache_dir (str): Folder for the parquet copies. Default is a 'cache' folder next to file_path.
+
+    Returns:
+        DataFrame: Activity classification data with one row every 30 s.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(file_path), 'cache')
+    cache_file = os.path.join(cache_dir, os.path.basename(file_path).replace('.csv.gz', '') + '.parquet')
+
+    # The cache is valid if it was built from a source file with the same mtime and size
+    source_stat = os.stat(file_path)
+    source_key = {b'source_mtime_ns': str(source_stat.st_mtime_ns).encode(),
+                  b'source_size': str(source_stat.st_size).encode()}
+    if os.path.exists(cache_file):
+        cache_metadata = pq.read_schema(cache_file).metadata or {}
+        if all(cache_metadata.get(key) == value for key, value in source_key.items()):
+            return pq.read_table(cache_file).to_pandas()
+
+    acc_df = read_acc_time_series(file_path)
+    for column in ACTIVITY_CLASS_COLUMNS:
+        if column in acc_df and acc_df[column].notna().all() and (acc_df[column] % 1 == 0).all():
+            acc_df[column] = acc_df[column].astype(np.int8)
+
+    # Write to a temporary file first so concurrent readers never see a partial cache file
+    table = pa.Table.from_pandas(acc_df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), **source_key})
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    pq.write_table(table, tmp_file)
+    os.replace(tmp_file, cache_file)
+
+    return acc_df
+
+
+def upsample_acc_df(acc_df, time_as_string=False):
+    """
+    Repeat every 30-second activity row three times at offsets of 0, 10 and 20 seconds.
+
+    Parameters:
+        acc_df (DataFrame): Activity data with a 'time' column of Oxford Biobank time strings or datetimes.
+        time_as_string (bool): If True, write 'time' as strings in the '%Y-%m-%d %H:%M:%S.%f%z' format,
+            keeping each row's UTC offset. If False (default), 'time' is a UTC datetime64 column.
+
+    Returns:
+        DataFrame: Upsampled activity data with one row every 10 s.
+    """
+    # Repeat each row three times, keeping the original index labels
+    upsampled_df = acc_df.iloc[np.repeat(np.arange(len(acc_df)), 3)].copy()
+    offsets = pd.to_timedelta(np.tile([0, 10, 20], len(acc_df)), unit='s')
+
+    time_values = acc_df['time']
+    if not time_as_string or pd.api.types.is_datetime64_any_dtype(time_values):
+        if not pd.api.types.is_datetime64_any_dtype(time_values):
+            time_values = parse_acc_time(time_values)
+        elif time_values.dt.tz is None:
+            time_values = time_values.dt.tz_localize('UTC')
+        utc_times = time_values.dt.tz_convert(None).to_numpy()
+        new_times = pd.DatetimeIndex(utc_times.repeat(3) + offsets.to_numpy()).tz_localize('UTC')
+        if time_as_string:
+            # Datetimes already carry their time zone, so let pandas format the offset
+            new_times = new_times.tz_convert(time_values.dt.tz).strftime('%Y-%m-%d %H:%M:%S.%f%z')
+        upsampled_df['time'] = new_times
+        return upsampled_df
+
+    # Split the strings into local wall time and UTC offset so each row keeps its own offset
+    cleaned = time_values.str.split(" [", regex=False).str[0]
+    offset_pattern = r'(Z|[+-]\d{2}:?\d{2})$'
+    utc_offset = cleaned.str.extract(offset_pattern)[0].fillna('')
+    utc_offset = utc_offset.str.replace(':', '', regex=False).replace('Z', '+0000')
+    local_time = pd.to_datetime(cleaned.str.replace(offset_pattern, '', regex=True), format='ISO8601')
+
+    new_times = local_time.to_numpy().repeat(3) + offsets.to_numpy()
+    new_times = np.char.replace(np.datetime_as_string(new_times, unit='us'), 'T', ' ')
+    upsampled_df['time'] = np.char.add(new_times, utc_offset.to_numpy().repeat(3).astype(str))
     return upsampled_df
 
 def find_sleep_period(acc_df):
+    """
+    Find the 15-minute (90-row) period between 23:00 and 08:00 with the fewest HR zeros.
+
+    Periods need at least 81 rows of sleep; if there is no such period, at least 81 rows of sleep or
+    sedentary behaviour combined are required instead. Window counts come from prefix sums so every
+    period is scored in one vectorised pass, and ties go to the earliest period.
+
+    Parameters:
+        acc_df (DataFrame): Activity data with one row every 10 s and 'time', 'sleep', 'sedentary' and 'HR' columns.
+
+    Returns:
+        tuple: (start, end) row indices of the best period, or None if no period qualifies.
+    """
     # Ensure the time column is in datetime format
     #acc df is a value every 10 s
     acc_df['time'] = pd.to_datetime(acc_df['time'], errors='coerce', utc=True)
 
-    def find_period(search_for_sleep=True):
-        best_period = None
-        min_hr_zeros = float('inf')  # Initialize with a very high number of HR zeros
-        
-        # Iterate over all potential 90-row periods (15 minutes)
-        for i in range(len(acc_df) - 90 + 1):
-            sleep_period = acc_df['sleep'].iloc[i:i + 90]
-            sedentary_period = acc_df['sedentary'].iloc[i:i + 90]
-            hr_period = acc_df['HR'].iloc[i:i + 90]
-            time_period = acc_df['time'].iloc[i:i + 90]
-            
-            # Get the start time of the period
-            start_time = time_period.iloc[0]
-            if pd.isnull(start_time):  # Handle any missing/invalid time values
-                continue
+    window = 90
+    min_rows = 81
+    n_periods = len(acc_df) - window + 1
+    if n_periods <= 0:
+        return None
 
-            # Check if the time is between 11 PM and 8 AM
-            if not (start_time.hour >= 23 or start_time.hour < 8):
-                continue  # Skip if outside of the time range
-            
-            # If searching for sleep, require at least 81 rows of sleep
-            if search_for_sleep:
-                if (sleep_period == 1).sum() < 81:
-                    continue  # Skip if insufficient sleep
-            else:
-                # If searching for a mix of sleep and sedentary, check for at least 81 rows
-                if (sleep_period == 1).sum() + (sedentary_period == 1).sum() < 81:
-                    continue  # Skip if there are not enough sleep/sedentary rows combined
-
-            # Count the number of HR zeros in the period
-            hr_zeros = (hr_period == 0).sum()
-
-            # If this period has fewer HR zeros than the current best, update best_period
-            if hr_zeros < min_hr_zeros:
-                min_hr_zeros = hr_zeros
-                best_period = (i, i + 90)
-        
-        return best_period
-    
-    # First try to find a sleep period
-    best_sleep_period = find_period(search_for_sleep=True)
-    
-    if best_sleep_period is not None:
-        return best_sleep_period  # Return the best sleep period if found
+    def window_counts(mask):
+        # Number of True values in every 90-row window from prefix sums
+        prefix = np.concatenate([[0], np.cumsum(mask, dtype=np.int64)])
+        return prefix[window:] - prefix[:-window]
+
+    sleep_counts = window_counts((acc_df['sleep'] == 1).to_numpy())
+    sedentary_counts = window_counts((acc_df['sedentary'] == 1).to_numpy())
+    hr_zeros = window_counts((acc_df['HR'] == 0).to_numpy())
+
+    # Only periods starting between 11 PM and 8 AM with a valid time are considered
+    start_times = acc_df['time'].iloc[:n_periods]
+    hours = start_times.dt.hour.to_numpy()
+    night = start_times.notna().to_numpy() & ((hours >= 23) | (hours < 8))
 
-    # If no sleep period is found, search for a mix of sleep or sedentary period
-    best_sedentary_period = find_period(search_for_sleep=False)
-    return best_sedentary_period  # Return the best sleep/sedentary period (if found)
+    # First look for sleep, then for a mix of sleep and sedentary periods
+    for valid in (night & (sleep_counts >= min_rows),
+                  night & (sleep_counts + sedentary_counts >= min_rows)):
+        if valid.any():
+            start = int(np.argmin(np.where(valid, hr_zeros, np.iinfo(np.int64).max)))
+            return (start, start + window)
+
+    return None
 
 
 
@@ -179,18 +359,9 @@ def resample_hr_data(hr_data, chunk_size=6):
         chunk_size (int): The size of each chunk for resampling. Default is 6.
 
     Returns:
-        list: Resampled HR data.
+        numpy array: Resampled HR data.
     """
-    hr_resampled = []
-    for i in range(0, len(hr_data), chunk_size):
-        # Take each chunk
-        chunk = hr_data[i:i+chunk_size]
-        # Filter out zeros
-        non_zero_chunk = chunk[chunk != 0]
-        # Calculate mean
-        median = np.mean(non_zero_chunk) if len(non_zero_chunk) > 0 else 0
-        hr_resampled.append(median)
-    return hr_resampled
+    return downsample_hr(hr_data, chunk_size, reducer='mean', dtype=np.float64)
 
 
 
@@ -200,7 +371,7 @@ def align_hr_and_acc(hr_30s_values, acc_df):
     Aligns HR values with accelerometer data by trimming or padding the HR values.
 
     Parameters:
-        hr_30s_values (list): List of heart rate values.
+        hr_30s_values (list or numpy array): Heart rate values.
         acc_df (DataFrame): Accelerometer data as a pandas DataFrame.
 
     Returns:
@@ -214,25 +385,29 @@ def align_hr_and_acc(hr_30s_values, acc_df):
     elif len(hr_30s_values) < len(acc_df):
         # Pad HR values with NaN if they are shorter
         padded_amount = len(acc_df) - len(hr_30s_values)
-        hr_30s_values += [np.nan] * padded_amount
+        hr_30s_values = np.concatenate([hr_30s_values, np.full(padded_amount, np.nan)])
         print(f'Padded {padded_amount} values')
 
     acc_df['HR'] = hr_30s_values
     return acc_df
 
 # Extract sleep-related data between 03:00 and 07:00
-def extract_sleep_data(acc_df):
+def extract_sleep_data(acc_df, local_tz='Europe/London'):
     """
     Extract non-zero HR values during sleep or sedentary periods between 03:00 and 07:00.
 
     Parameters:
         acc_df (DataFrame): Accelerometer data with a time column and HR values.
+        local_tz (str): Time zone of the recording, used when 'time' holds UTC datetimes.
 
     Returns:
         DataFrame: Filtered DataFrame with sleep or sedentary rows and non-zero HR values.
     """
-    # Ensure 'time_cleaned' column is in datetime format
-    acc_df['time_cleaned'] = pd.to_datetime(acc_df['time'].str.split("[").str[0])
+    # Ensure 'time_cleaned' column is in datetime format, using local time for parsed UTC timestamps
+    if pd.api.types.is_datetime64_any_dtype(acc_df['time']):
+        acc_df['time_cleaned'] = acc_df['time'].dt.tz_convert(local_tz)
+    else:
+        acc_df['time_cleaned'] = pd.to_datetime(acc_df['time'].str.split("[").str[0])
 
     # Extract the time of day as a datetime.time object
     acc_df['time_of_day'] = acc_df['time_cleaned'].dt.time
@@ -244,4 +419,458 @@ def extract_sleep_data(acc_df):
     # Further filter rows where 'sleep' or 'sedentary' is true
     sleep_df = sleep_df[(sleep_df['sleep'] == 1) | (sleep_df['sedentary'] == 1)]
 
-    return sleep_df
\ No newline at end of file
+    return sleep_df
+
+
+def read_ecg_window(ecg_file, start_s, duration_s, fs):
+    """
+    Read a window of ECG from a parquet file, loading only the row groups that overlap it.
+
+    Parameters:
+        ecg_file (str): Path to the ECG parquet file.
+        start_s (float): Start of the window in seconds from the start of the recording.
+        duration_s (float): Length of the window in seconds.
+        fs (float): Sampling frequency of the stored ECG.
+
+    Returns:
+        numpy array: ECG samples int(start_s*fs) to int(start_s*fs) + int(duration_s*fs).
+    """
+    start = int(start_s * fs)
+    stop = start + int(duration_s * fs)
+
+    parquet_file = pq.ParquetFile(ecg_file)
+    metadata = parquet_file.metadata
+    group_rows = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+    group_starts = np.concatenate([[0], np.cumsum(group_rows)])
+
+    # Find the row groups that overlap [start, stop)
+    first = max(np.searchsorted(group_starts, start, side='right') - 1, 0)
+    last = min(np.searchsorted(group_starts, stop, side='left'), metadata.num_row_groups)
+    if first >= metadata.num_row_groups or last <= first:
+        return np.zeros(0)
+
+    column = parquet_file.schema_arrow.names[0]
+    table = parquet_file.read_row_groups(list(range(first, last)), columns=[column])
+    ecg = table.column(0).to_numpy()
+
+    offset = group_starts[first]
+    return ecg[start - offset:stop - offset]
+
+
+def assemble_clean_ecg(ecg, hr_values, block_len, max_samples=None, dtype=np.float32):
+    """
+    Join the ECG blocks whose HR is non-zero into one array, keeping track of the noisy blocks.
+
+    Block i covers ecg[i*block_len:(i+1)*block_len] and is clean if hr_values[i] != 0. Blocks are taken in order
+    until max_samples clean samples have been collected, as in the loop of the short-term HRV notebook, and the
+    clean blocks are selected with one boolean index instead of sample by sample.
+
+    Parameters:
+        ecg (array): ECG samples of the period, starting at the first block.
+        hr_values (array): HR value of each 10s block (0 = noisy).
+        block_len (int): Number of ECG samples per block, e.g. int(10 * ecg_fs).
+        max_samples (int): Stop after the block that brings the clean samples to at least max_samples.
+            Default is None (use every block).
+        dtype: dtype of the returned ECG. Default is float32.
+
+    Returns:
+        tuple: (ecg_clean, noisy_segments). ecg_clean holds the clean blocks end to end (a view of ecg when they
+        are contiguous and already of dtype); noisy_segments is an array with the start sample of each noisy block
+        before the stopping point.
+    """
+    ecg = np.asarray(ecg)
+    clean = np.asarray(hr_values) != 0
+    block_starts = np.arange(len(clean), dtype=np.int64) * block_len
+    block_lens = np.clip(len(ecg) - block_starts, 0, block_len)
+
+    # Stop after the first block at which enough clean samples have been collected
+    if max_samples is not None:
+        clean_samples = np.cumsum(np.where(clean, block_lens, 0))
+        enough = np.flatnonzero(clean_samples >= max_samples)
+        if len(enough):
+            clean, block_starts, block_lens = clean[:enough[0] + 1], block_starts[:enough[0] + 1], block_lens[:enough[0] + 1]
+
+    noisy_segments = block_starts[~clean]
+    clean_idx = np.flatnonzero(clean & (block_lens > 0))
+    if len(clean_idx) == 0:
+        return np.zeros(0, dtype=dtype), noisy_segments
+
+    # A single run of clean blocks is returned as a view of the ECG
+    if clean_idx[-1] - clean_idx[0] + 1 == len(clean_idx):
+        start = block_starts[clean_idx[0]]
+        stop = block_starts[clean_idx[-1]] + block_lens[clean_idx[-1]]
+        return ecg[start:stop].astype(dtype, copy=False), noisy_segments
+
+    # Otherwise select the full blocks with one boolean index on the (n_blocks, block_len) view
+    n_full = len(ecg) // block_len
+    full_idx = clean_idx[clean_idx < n_full]
+    ecg_clean = ecg[:n_full * block_len].reshape(n_full, block_len)[full_idx].astype(dtype, copy=False).ravel()
+    if clean_idx[-1] >= n_full:
+        # Partial block at the end of the ECG
+        ecg_clean = np.concatenate([ecg_clean, ecg[n_full * block_len:].astype(dtype, copy=False)])
+    return ecg_clean, noisy_segments
+
+
+def load_beat_index(file_path):
+    """
+    Load a beat index written by the HR pass (HR/mainHR_script.py).
+
+    Parameters:
+        file_path (str): Path to the beat_index/{patient_id}.npz file.
+
+    Returns:
+        dict: 'beat_positions' (absolute sample positions of the R-peaks at fs), 'window_offsets' (beats of
+        window i are beat_positions[window_offsets[i]:window_offsets[i+1]]), 'quality' and 'hr' per 10s window,
+        'fs' and 'window_len'.
+    """
+    with np.load(file_path) as data:
+        beat_index = {key: data[key] for key in data.files}
+    beat_index['fs'] = int(beat_index['fs'])
+    beat_index['window_len'] = int(beat_index['window_len'])
+    return beat_index
+
+
+def beat_index_nn(beat_index, start_s=0, duration_s=None):
+    """
+    Get the NN intervals of the acceptable windows in a span of the recording from a beat index.
+
+    The intervals are the same as extract_nn returns for each window: consecutive beats within a window of
+    acceptable quality, in seconds. Intervals are not formed across window boundaries.
+
+    Parameters:
+        beat_index (dict): Beat index as returned by load_beat_index.
+        start_s (float): Start of the span in seconds from the start of the recording. Default is 0.
+        duration_s (float): Length of the span in seconds. Default is the rest of the recording.
+
+    Returns:
+        numpy array: NN intervals in seconds, in recording order.
+    """
+    fs, window_len = beat_index['fs'], beat_index['window_len']
+    n_windows = len(beat_index['quality'])
+
+    # Windows whose start lies in the span
+    first = int(np.ceil(start_s * fs / window_len))
+    last = n_windows if duration_s is None else min(int(np.ceil((start_s + duration_s) * fs / window_len)), n_windows)
+    if last <= first:
+        return np.zeros(0)
+
+    offsets = beat_index['window_offsets']
+    positions = beat_index['beat_positions'][offsets[first]:offsets[last]]
+
+    # Window of every beat, and whether the next beat is in the same acceptable window
+    window = np.repeat(np.arange(first, last), np.diff(offsets[first:last + 1]))
+    same_window = (window[1:] == window[:-1]) & (beat_index['quality'][window[:-1]] == 1)
+
+    return np.diff(positions)[same_window] / fs
+
+
+def night_hrv_windows(beat_index, acc_df, window_s=300, step_s=30, local_tz='Europe/London', night_hours=(23, 8),
+                      min_nn=30):
+    """
+    Compute short-term HRV over every clean window of sleep across all nights, from a beat index.
+
+    A window qualifies when all its 10s rows are classified as sleep, start between night_hours in local time and
+    have acceptable ECG quality. The NN intervals come from the beat index, so the ECG is not read again. Ectopic
+    beats are removed once per continuous clean stretch, and the time domain metrics of the sliding windows are
+    computed from prefix sums (hrv_metrics.sliding_window_hrv).
+
+    Parameters:
+        beat_index (dict): Beat index as returned by load_beat_index.
+        acc_df (DataFrame): Activity data with one row every 10 s (see upsample_acc_df), aligned with the windows
+            of the beat index, with 'time' and 'sleep' columns.
+        window_s (int): Length of the HRV windows in seconds. Default is 5 minutes.
+        step_s (int): Step between the starts of consecutive windows in seconds. Default is 30 s.
+        local_tz (str): Time zone used for the night hours and night dates. Default is 'Europe/London'.
+        night_hours (tuple): Start and end hour of the night in local time. Default is 23:00 to 08:00.
+        min_nn (int): Minimum number of NN intervals in a window. Default is 30.
+
+    Returns:
+        tuple: (window_df, night_df). window_df has the night, start time, HRV_COLUMNS and ectopic beat count of
+        every window; night_df has the number of windows and the median, 25th and 75th percentile of each HRV
+        metric per night.
+    """
+    fs, window_len = beat_index['fs'], beat_index['window_len']
+    rows_per_window = int(round(window_s * fs / window_len))
+    step_rows = max(int(round(step_s * fs / window_len)), 1)
+    n_rows = min(len(beat_index['quality']), len(acc_df))
+
+    # Rows that are clean sleep during the night
+    times = pd.to_datetime(acc_df['time'].iloc[:n_rows], utc=True).dt.tz_convert(local_tz)
+    hours = times.dt.hour.to_numpy()
+    start_hour, end_hour = night_hours
+    in_night = (hours >= start_hour) | (hours < end_hour)
+    clean = (beat_index['quality'][:n_rows] == 1) & (acc_df['sleep'].iloc[:n_rows].to_numpy() == 1) & in_night
+
+    # NN intervals in recording order, each assigned to the row of its second beat. Intervals spanning the boundary
+    # between two clean rows are kept, so every clean stretch is one continuous NN series
+    offsets = beat_index['window_offsets'][:n_rows + 1]
+    positions = beat_index['beat_positions'][:offsets[-1]]
+    beat_window = np.repeat(np.arange(n_rows), np.diff(offsets))
+    prev_window, next_window = beat_window[:-1], beat_window[1:]
+    crosses = (next_window == prev_window + 1) & clean[prev_window] & clean[next_window]
+    keep = (next_window == prev_window) | crosses
+    nn = np.diff(positions)[keep] / fs * 1000
+    nn_offsets = np.concatenate([[0], np.cumsum(np.bincount(next_window[keep], minlength=n_rows))])
+
+    # Whether the first interval of a row comes from the previous row, which is not part of a window starting there
+    enters = np.zeros(n_rows, dtype=np.int64)
+    enters[next_window[crosses]] = 1
+
+    # Remove ectopic beats once per continuous clean stretch
+    edges = np.diff(np.concatenate([[0], clean.astype(np.int8), [0]]))
+    run_starts, run_stops = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    runs = [nn[nn_offsets[a]:nn_offsets[b]] for a, b in zip(run_starts, run_stops)]
+    ectopic = np.zeros(len(nn), dtype=bool)
+    if runs:
+        nn_runs, run_lengths = pad_nn_series(runs)
+        nn_clean, _ = remove_ectopic_beats_batch(nn_runs, run_lengths)
+        removed = np.isnan(nn_clean) & ~np.isnan(nn_runs)
+        nn_clean = interpolate_nan_batch(nn_clean, run_lengths)
+        in_run = np.arange(nn_runs.shape[1]) < run_lengths[:, None]
+        run_idx = np.concatenate([np.arange(nn_offsets[a], nn_offsets[b]) for a, b in zip(run_starts, run_stops)])
+        nn = nn.copy()
+        nn[run_idx] = nn_clean[in_run]
+        ectopic[run_idx] = removed[in_run]
+
+    # Window starts whose rows are all clean, stepping by step_rows
+    clean_prefix = np.concatenate([[0], np.cumsum(clean)])
+    window_starts = np.arange(0, max(n_rows - rows_per_window + 1, 0), step_rows)
+    window_starts = window_starts[clean_prefix[window_starts + rows_per_window] - clean_prefix[window_starts] == rows_per_window]
+
+    starts = nn_offsets[window_starts] + enters[window_starts]
+    stops = nn_offsets[window_starts + rows_per_window]
+    enough = stops - starts >= min_nn
+    window_starts, starts, stops = window_starts[enough], starts[enough], stops[enough]
+
+    window_df = sliding_window_hrv(nn, starts, stops)
+    ectopic_prefix = np.concatenate([[0], np.cumsum(ectopic)])
+    window_df['ectopic_beats'] = ectopic_prefix[stops] - ectopic_prefix[starts]
+
+    # Nights are labelled with the date of the evening they start on
+    window_times = times.iloc[window_starts].reset_index(drop=True)
+    window_df.insert(0, 'start_time', window_times)
+    window_df.insert(0, 'night', (window_times - pd.Timedelta(hours=12)).dt.date)
+
+    grouped = window_df.groupby('night')[HRV_COLUMNS]
+    night_df = pd.concat({
+        'median': grouped.median(),
+        'q25': grouped.quantile(0.25),
+        'q75': grouped.quantile(0.75),
+    }, axis=1).swaplevel(axis=1)
+    night_df.columns = [f'{metric}_{stat}' for metric, stat in night_df.columns]
+    night_df = night_df[[f'{metric}_{stat}' for metric in HRV_COLUMNS for stat in ['median', 'q25', 'q75']]]
+    night_df.insert(0, 'n_windows', window_df.groupby('night').size())
+
+    return window_df, night_df
+
+
+class RunningStats:
+    """
+    Running count, mean and variance of a stream of values (Welford's algorithm, updated a batch at a time).
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, values):
+        """
+        Add a batch of values, combining its mean and sum of squared deviations with the running ones.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        n_batch = len(values)
+        if n_batch == 0:
+            return
+        mean_batch = values.mean()
+        m2_batch = np.sum((values - mean_batch) ** 2)
+
+        n = self.n + n_batch
+        delta = mean_batch - self.mean
+        self.mean += delta * n_batch / n
+        self.m2 += m2_batch + delta ** 2 * self.n * n_batch / n
+        self.n = n
+
+    def std(self, ddof=1):
+        """
+        Standard deviation of the values seen so far (NaN if there are not more than ddof values).
+        """
+        if self.n <= ddof:
+            return np.nan
+        return np.sqrt(self.m2 / (self.n - ddof))
+
+
+def long_term_hrv_from_ecg(ecg_file, fs, start_s=0, duration_s=24 * 60 * 60, segment_s=300, desired_fs=250,
+                           window_s=10, thresh=0.66, min_segment_nn=2):
+    """
+    Calculate long-term HRV (SDNN24, SDANN, SDNN index) from the ECG, one segment at a time.
+
+    Each segment is read with read_ecg_window, resampled to desired_fs and split into 10s windows, and extract_nn
+    gives the NN intervals of every window of acceptable quality. Only the NN intervals of the current segment
+    are held in memory: the overall statistics are accumulated with RunningStats.
+
+    Parameters:
+    - ecg_file: Path to the ECG parquet file.
+    - fs: Sampling frequency of the stored ECG.
+    - start_s: Start of the analysis in seconds from the start of the recording. Default is 0.
+    - duration_s: Length of the analysis in seconds. Default is 24 hours.
+    - segment_s: Length of the segments used for SDANN and the SDNN index in seconds. Default is 5 minutes.
+    - desired_fs: Sampling frequency the ECG is resampled to before beat detection. Default is 250 Hz.
+    - window_s: Length of the windows passed to extract_nn in seconds. Default is 10 s.
+    - thresh: Correlation threshold of the signal quality assessment. Default is 0.66.
+    - min_segment_nn: Minimum number of NN intervals for a segment to count towards SDANN and the SDNN index.
+
+    Returns:
+    - hrv: Dictionary with 'SDNN24', 'MeanNN24', 'SDANN' and 'SDNN_index' in ms (sample standard deviations),
+      plus the number of NN intervals ('n_nn') and of segments used ('n_segments').
+    """
+    window_len = int(window_s * desired_fs)
+
+    nn_stats = RunningStats()
+    segment_mean_stats = RunningStats()
+    segment_sd_stats = RunningStats()
+
+    for segment_start in np.arange(start_s, start_s + duration_s, segment_s):
+        ecg = read_ecg_window(ecg_file, segment_start, min(segment_s, start_s + duration_s - segment_start), fs)
+        if len(ecg) < window_s * fs:
+            # End of the recording
+            break
+
+        ecg = nk.signal_resample(ecg, sampling_rate=fs, desired_sampling_rate=desired_fs)
+        n_windows = len(ecg) // window_len
+
+        segment_nn = []
+        for window in ecg[:n_windows * window_len].reshape(n_windows, window_len):
+            try:
+                nn, _ = extract_nn(window, desired_fs, thresh)
+            except ZeroDivisionError:
+                # No beat far enough from the window edges to build a template
+                continue
+            segment_nn.append(np.asarray(nn, dtype=np.float64))
+
+        segment_nn = np.concatenate(segment_nn) * 1000 if segment_nn else np.zeros(0)  # Convert to milliseconds
+        nn_stats.update(segment_nn)
+        if len(segment_nn) >= min_segment_nn:
+            segment_mean_stats.update([segment_nn.mean()])
+            segment_sd_stats.update([segment_nn.std(ddof=1)])
+
+    return {
+        'SDNN24': nn_stats.std(),
+        'MeanNN24': nn_stats.mean if nn_stats.n > 0 else np.nan,
+        'SDANN': segment_mean_stats.std(),
+        'SDNN_index': segment_sd_stats.mean if segment_sd_stats.n > 0 else np.nan,
+        'n_nn': nn_stats.n,
+        'n_segments': segment_mean_stats.n,
+    }
+
+
+@dataclass
+class ActivityHRSummary:
+    """
+    Activity and HR metrics for one patient, as computed by summarise_activity_hr.
+    """
+    resting_hr: float
+    max_hr: float
+    min_hr: float
+    time_in_mvpa: float
+    time_in_lpa: float
+    time_in_sb: float
+    mvpa_hr: float
+    lpa_hr: float
+    sb_hr: float
+
+    def to_columns(self):
+        """
+        Return the metrics keyed by their column names in sensors_data.csv.
+        """
+        return {
+            'Resting HR': self.resting_hr,
+            'Max HR': self.max_hr,
+            'Min HR': self.min_hr,
+            'Time in MVPA': self.time_in_mvpa,
+            'Time in LPA': self.time_in_lpa,
+            'Time in SB': self.time_in_sb,
+            'MVPA HR': self.mvpa_hr,
+            'LPA HR': self.lpa_hr,
+            'SB HR': self.sb_hr,
+        }
+
+
+def summarise_activity_hr(hr_values, acc_df, days, local_tz='Europe/London'):
+    """
+    Compute the resting, max and min HR and the time and HR in MVPA, LPA and SB for one patient.
+
+    The 10-second HR values are reduced to 30-second medians and aligned with the activity rows as in
+    align_hr_and_acc, then every metric is taken from grouped reductions over numpy arrays instead of
+    separate filtered copies of acc_df.
+
+    Parameters:
+        hr_values (numpy array): HR values, one every 10 seconds.
+        acc_df (DataFrame): Oxford Biobank activity data with 'time', 'sleep', 'sedentary', 'light' and
+            'moderate-vigorous' columns, one row every 30 seconds.
+        days (float): Days of good quality wear time, used to give the times per day.
+        local_tz (str): Time zone of the recording, used when 'time' holds UTC datetimes.
+
+    Returns:
+        ActivityHRSummary: HR metrics in bpm and times in minutes per day.
+    """
+    n = len(acc_df)
+
+    # Align the 30s HR values with the activity rows, padding with NaN
+    hr_30s_values = average_hr_30s(hr_values)[:n]
+    hr = np.full(n, np.nan)
+    hr[:len(hr_30s_values)] = hr_30s_values
+    hr_finite = np.isfinite(hr)
+    hr_valid = hr_finite & (hr != 0)
+
+    # Time of day in local time, used for the 03:00 to 07:00 resting window
+    time_values = acc_df['time']
+    if not pd.api.types.is_datetime64_any_dtype(time_values):
+        time_values = parse_acc_time(time_values)
+    if time_values.dt.tz is not None:
+        time_values = time_values.dt.tz_convert(local_tz)
+    # Wall-clock time of day (as .dt.time), not the time elapsed since midnight, which is off by an hour on DST days
+    time_of_day = (time_values.dt.hour.to_numpy() * 3600 + time_values.dt.minute.to_numpy() * 60
+                   + time_values.dt.second.to_numpy() + time_values.dt.microsecond.to_numpy() / 1e6)
+    night = (time_of_day >= 3 * 3600) & (time_of_day <= 7 * 3600)
+
+    # Activity class masks in the order MVPA, LPA, SB
+    classes = np.column_stack([acc_df[column].to_numpy() == 1 for column in ['moderate-vigorous', 'light', 'sedentary']])
+    sleep = acc_df['sleep'].to_numpy() == 1
+    sedentary = classes[:, 2]
+
+    def masked_mean(mask):
+        count = np.count_nonzero(mask)
+        return hr[mask].sum() / count if count > 0 else np.nan
+
+    # Grouped counts and HR sums for every class at once
+    class_counts = classes.sum(axis=0)
+    class_hr_counts = (classes & hr_valid[:, None]).sum(axis=0)
+    class_hr_sums = np.where(hr_valid, hr, 0) @ classes
+    with np.errstate(invalid='ignore', divide='ignore'):
+        class_hr = np.where(class_hr_counts > 0, class_hr_sums / class_hr_counts, np.nan)
+
+    # Resting HR from night-time sleep or sedentary rows, falling back to all sedentary rows
+    resting_rows = night & (sleep | sedentary) & (hr != 0)
+    if resting_rows.any():
+        resting_hr = masked_mean(resting_rows & hr_finite)
+    else:
+        resting_hr = masked_mean(sedentary & hr_finite)
+
+    max_hr = hr[hr_finite].max() if hr_finite.any() else np.nan
+    min_hr = hr[hr_valid].min() if hr_valid.any() else np.nan
+
+    # Each row is 30s, so the time in minutes per day is half the row count divided by the days
+    time_in_class = (class_counts / 2) / days
+
+    return ActivityHRSummary(
+        resting_hr=float(resting_hr),
+        max_hr=float(max_hr),
+        min_hr=float(min_hr),
+        time_in_mvpa=float(time_in_class[0]),
+        time_in_lpa=float(time_in_class[1]),
+        time_in_sb=float(time_in_class[2]),
+        mvpa_hr=float(class_hr[0]),
+        lpa_hr=float(class_hr[1]),
+        sb_hr=float(class_hr[2]),
+    )
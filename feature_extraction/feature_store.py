@@ -0,0 +1,191 @@
+import os
+import glob
+import uuid
+import pandas as pd
+
+
+#column every feature group is keyed by
+KEY = 'Patient ID'
+
+#group the joined view starts from, holding one row per patient of the cohort
+BASE_GROUP = 'cohort'
+
+#features of each group, used to split an existing sensors_data.csv into the store
+FEATURE_GROUPS = {
+    'cohort': ['file_name', 'Start', 'Wear time', 'missing ACC (% of total signal)',
+               'missing ECG overall (% of total signal)', 'Missing ECG from electrode (% of total signal)'],
+    'data_quality': ['%_ECG_acceptable_quality', 'Hours of data collected', 'wear_hrs', 'acc_qual'],
+    'steps': ['steps', 'MVPA steps', 'Q1', 'Q2', 'Q3', 'Q95'],
+    'activity_hr': ['Resting HR', 'Max HR', 'Min HR', 'Time in MVPA', 'Time in LPA', 'Time in SB', 'MVPA HR',
+                    'LPA HR', 'SB HR'],
+    'short_term_hrv': ['RMSSD', 'SDNN', 'pNN50', 'MeanNN', 'LF', 'VLF', 'HF', 'LF_HF', 'SD1', 'SD2'],
+}
+FEATURE_GROUPS['short_term_hrv'] += [f'{metric}_night' for metric in FEATURE_GROUPS['short_term_hrv']]
+
+
+def group_file(store_dir, group):
+    """
+    Path of the Parquet file of a feature group.
+    """
+    return os.path.join(store_dir, f'{group}.parquet')
+
+
+def list_groups(store_dir):
+    """
+    Names of the feature groups in the store, in alphabetical order.
+    """
+    return sorted(os.path.basename(file)[:-len('.parquet')] for file in glob.glob(os.path.join(store_dir, '*.parquet')))
+
+
+def write_group(df, group, store_dir, columns=None):
+    """
+    Write one feature group of the store, replacing the previous version of that group only.
+
+    The group is written to a temporary file in the store and then moved over the old file, so readers never see a
+    half-written group and stages writing different groups can run at the same time.
+
+    Args:
+    - df: dataframe with the 'Patient ID' column and the features of the group.
+    - group: name of the feature group.
+    - store_dir: folder of the feature store.
+    - columns: features to store. Default is every column of df.
+
+    Returns:
+    - file: path of the written Parquet file.
+    """
+    if columns is None:
+        columns = [column for column in df.columns if column != KEY]
+    group_df = df[[KEY] + list(columns)].reset_index(drop=True)
+
+    if group_df[KEY].isna().any():
+        raise ValueError(f"Feature group '{group}' has rows without a {KEY}")
+    duplicated = group_df[KEY][group_df[KEY].duplicated()].unique()
+    if len(duplicated) > 0:
+        raise ValueError(f"Feature group '{group}' has duplicated {KEY} values: {list(duplicated)}")
+
+    os.makedirs(store_dir, exist_ok=True)
+    file = group_file(store_dir, group)
+    tmp_file = f'{file}.{uuid.uuid4().hex}.tmp'
+    try:
+        group_df.to_parquet(tmp_file, index=False)
+        os.replace(tmp_file, file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return file
+
+
+def upsert_group(df, group, store_dir, columns=None):
+    """
+    Write the rows of df into a feature group, keeping the stored rows of every other patient.
+
+    Used when a stage only recomputes some patients: their rows replace the stored ones and the group is then
+    rewritten atomically with write_group.
+
+    Args:
+    - df: dataframe with the 'Patient ID' column and the features of the recomputed patients.
+    - group: name of the feature group.
+    - store_dir: folder of the feature store.
+    - columns: features to store. Default is every column of df.
+
+    Returns:
+    - file: path of the written Parquet file.
+    """
+    if columns is None:
+        columns = [column for column in df.columns if column != KEY]
+    new_df = df[[KEY] + list(columns)]
+
+    if os.path.exists(group_file(store_dir, group)):
+        stored_df = read_group(group, store_dir)
+        stored_df = stored_df[~stored_df[KEY].isin(new_df[KEY])]
+        new_df = pd.concat([stored_df, new_df], ignore_index=True)
+    return write_group(new_df, group, store_dir)
+
+
+def read_group(group, store_dir, columns=None):
+    """
+    Read one feature group of the store.
+
+    Args:
+    - group: name of the feature group.
+    - store_dir: folder of the feature store.
+    - columns: features to read. Default is every feature of the group.
+
+    Returns:
+    - group_df: dataframe with the 'Patient ID' column and the features of the group.
+    """
+    return pd.read_parquet(group_file(store_dir, group), columns=None if columns is None else [KEY] + list(columns))
+
+
+def load_features(store_dir, groups=None, columns=None):
+    """
+    Joined view of several feature groups, one row per patient.
+
+    The view starts from the first group (the 'cohort' group by default) and the other groups are left-joined on
+    'Patient ID', so patients missing from a later stage have NaN features. Column types are those stored in the
+    Parquet files.
+
+    Args:
+    - store_dir: folder of the feature store.
+    - groups: names of the groups to join. Default is every group, starting with 'cohort'.
+    - columns: features to keep. Default is every feature of the groups.
+
+    Returns:
+    - df: dataframe with the 'Patient ID' column and the features of every group.
+    """
+    if groups is None:
+        groups = list_groups(store_dir)
+        if BASE_GROUP in groups:
+            groups = [BASE_GROUP] + [group for group in groups if group != BASE_GROUP]
+    if len(groups) == 0:
+        raise FileNotFoundError(f"No feature groups found in {store_dir}")
+
+    df = None
+    seen = {}
+    for group in groups:
+        group_df = read_group(group, store_dir)
+        if columns is not None:
+            group_df = group_df[[KEY] + [column for column in group_df.columns if column in columns]]
+
+        # A feature stored in two groups would be ambiguous in the joined view
+        for column in group_df.columns.drop(KEY):
+            if column in seen:
+                raise ValueError(f"Feature '{column}' is in both the '{seen[column]}' and '{group}' groups")
+            seen[column] = group
+
+        df = group_df if df is None else df.merge(group_df, on=KEY, how='left', validate='one_to_one')
+
+    return df
+
+
+def import_csv(csv_file, store_dir, feature_groups=FEATURE_GROUPS, rest_group='legacy'):
+    """
+    Split an existing sensors_data.csv into the groups of the feature store.
+
+    Columns that are not in any of the feature_groups (e.g. long-term HRV features computed outside these notebooks)
+    are written to the rest_group, so nothing in the CSV is lost.
+
+    Args:
+    - csv_file: path of the CSV with one row per patient.
+    - store_dir: folder of the feature store.
+    - feature_groups: dictionary mapping each group name to its features. Default is FEATURE_GROUPS.
+    - rest_group: group of the columns not in any of the feature_groups. Default is 'legacy'.
+
+    Returns:
+    - written: dictionary mapping each written group to its features.
+    """
+    df = pd.read_csv(csv_file)
+
+    written = {}
+    for group, features in feature_groups.items():
+        present = [column for column in features if column in df.columns]
+        if present:
+            write_group(df, group, store_dir, present)
+            written[group] = present
+
+    grouped = {column for features in written.values() for column in features}
+    rest = [column for column in df.columns if column != KEY and column not in grouped]
+    if rest:
+        write_group(df, rest_group, store_dir, rest)
+        written[rest_group] = rest
+    return written
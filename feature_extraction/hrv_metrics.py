@@ -0,0 +1,305 @@
+import numpy as np
+import pandas as pd
+from scipy import signal
+from scipy.integrate import trapezoid
+
+
+#columns returned by compute_hrv_batch, named as in the feature dataframes
+HRV_COLUMNS = ['RMSSD', 'SDNN', 'pNN50', 'MeanNN', 'LF', 'VLF', 'HF', 'LF_HF', 'SD1', 'SD2']
+
+
+def pad_nn_series(nn_series):
+    """
+    Stack NN interval series of different lengths into a NaN padded 2D array.
+
+    Args:
+    - nn_series: list of 1D arrays or lists of NN intervals in ms.
+
+    Returns:
+    - nn: (n_series, max_len) float array, NaN after the end of each series.
+    - lengths: int array with the length of each series.
+    """
+    lengths = np.array([len(series) for series in nn_series], dtype=np.int64)
+    nn = np.full((len(nn_series), lengths.max() if len(lengths) else 0), np.nan)
+    mask = np.arange(nn.shape[1]) < lengths[:, None]
+    if len(nn_series):
+        nn[mask] = np.concatenate([np.asarray(series, dtype=np.float64) for series in nn_series])
+    return nn, lengths
+
+
+def remove_ectopic_beats_batch(nn, lengths, removing_rule=0.2):
+    """
+    Batch version of hrvanalysis.remove_ectopic_beats with the malik rule.
+
+    An interval differing by more than removing_rule from the one before it is replaced with NaN, and the
+    interval after a removed one is always kept, exactly as in the sequential hrvanalysis loop.
+
+    Args:
+    - nn: (n_series, max_len) NaN padded array of NN intervals in ms.
+    - lengths: length of each series.
+    - removing_rule: maximum relative difference with the previous interval. Default is 0.2.
+
+    Returns:
+    - nn_clean: copy of nn with the ectopic intervals set to NaN.
+    - ectopic_count: number of intervals removed from each series.
+    """
+    in_series = np.arange(nn.shape[1]) < lengths[:, None]
+
+    # an interval fails if it is not within bounds of the previous (original) interval
+    with np.errstate(invalid='ignore'):
+        within = np.abs(nn[:, :-1] - nn[:, 1:]) <= removing_rule * nn[:, :-1]
+    fails = np.zeros(nn.shape, dtype=bool)
+    fails[:, 1:] = ~within & in_series[:, 1:]
+
+    # in a run of failing intervals the removals alternate, starting with the first of the run
+    idx = np.arange(nn.shape[1])
+    last_pass = np.maximum.accumulate(np.where(fails, -1, idx), axis=1)
+    removed = fails & ((idx - last_pass - 1) % 2 == 0)
+
+    nn_clean = nn.copy()
+    nn_clean[removed] = np.nan
+    return nn_clean, removed.sum(axis=1)
+
+
+def interpolate_nan_batch(nn, lengths):
+    """
+    Batch version of hrvanalysis.interpolate_nan_values with linear interpolation.
+
+    NaNs inside each series are linearly interpolated by position, leading NaNs take the first valid value and
+    trailing NaNs the last one. Series without any valid value are left as they are.
+
+    Args:
+    - nn: (n_series, max_len) NaN padded array of NN intervals in ms.
+    - lengths: length of each series.
+
+    Returns:
+    - nn_filled: copy of nn with the NaNs within each series filled in.
+    """
+    n_series, max_len = nn.shape
+    in_series = np.arange(max_len) < lengths[:, None]
+    valid = in_series & ~np.isnan(nn)
+    to_fill = in_series & ~valid & valid.any(axis=1)[:, None]
+
+    nn_filled = nn.copy()
+    if not to_fill.any():
+        return nn_filled
+
+    # shift every series to its own range of positions so that one np.interp call handles the whole batch;
+    # the first and last valid values of each series are repeated at the series edges so that leading and
+    # trailing NaNs are filled with them instead of with values from the neighbouring series
+    rows, cols = np.nonzero(valid)
+    first = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+    last = np.r_[first[1:] - 1, len(rows) - 1]
+    series_rows = rows[first]
+    offset = max_len + 1
+
+    xp = np.concatenate([series_rows * offset - 0.5, rows * offset + cols, series_rows * offset + max_len - 0.5])
+    fp = np.concatenate([nn[rows[first], cols[first]], nn[rows, cols], nn[rows[last], cols[last]]])
+    order = np.argsort(xp, kind='stable')
+
+    fill_rows, fill_cols = np.nonzero(to_fill)
+    nn_filled[fill_rows, fill_cols] = np.interp(fill_rows * offset + fill_cols, xp[order], fp[order])
+    return nn_filled
+
+
+def time_domain_batch(nn, lengths):
+    """
+    Time domain and Poincare plot features of a batch of complete (NaN free) NN series.
+
+    Follows hrvanalysis get_time_domain_features and get_poincare_plot_features: SDNN, SD1 and SD2 use ddof=1,
+    RMSSD and pNN50 are taken over the successive differences.
+
+    Returns:
+    - features: dictionary of arrays with 'MeanNN', 'SDNN', 'RMSSD', 'pNN50', 'SD1' and 'SD2' per series.
+    """
+    in_series = np.arange(nn.shape[1]) < lengths[:, None]
+    x = np.where(in_series, nn, 0.0)
+    n = lengths.astype(np.float64)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_nn = x.sum(axis=1) / n
+        sdnn = np.sqrt(np.sum(np.where(in_series, (x - mean_nn[:, None]) ** 2, 0.0), axis=1) / (n - 1))
+
+        diff_valid = in_series[:, 1:]
+        diff = np.where(diff_valid, np.diff(x, axis=1), 0.0)
+        n_diff = n - 1
+        rmssd = np.sqrt(np.sum(diff ** 2, axis=1) / n_diff)
+        pnn50 = 100 * np.sum(np.abs(diff) > 50, axis=1) / n_diff
+
+        mean_diff = diff.sum(axis=1) / n_diff
+        var_diff = np.sum(np.where(diff_valid, (diff - mean_diff[:, None]) ** 2, 0.0), axis=1) / (n_diff - 1)
+        sd1 = np.sqrt(var_diff * 0.5)
+        sd2 = np.sqrt(2 * sdnn ** 2 - 0.5 * var_diff)
+
+    return {'MeanNN': mean_nn, 'SDNN': sdnn, 'RMSSD': rmssd, 'pNN50': pnn50, 'SD1': sd1, 'SD2': sd2}
+
+
+def frequency_domain_batch(nn, lengths, sampling_frequency=4, vlf_band=(0.003, 0.04), lf_band=(0.04, 0.15),
+                           hf_band=(0.15, 0.40)):
+    """
+    Welch band powers of a batch of complete (NaN free) NN series, as hrvanalysis get_frequency_domain_features.
+
+    Each series is linearly resampled at sampling_frequency on its cumulative time axis, and series with the same
+    resampled length share a single signal.welch call (Hann window, nfft=4096).
+
+    Returns:
+    - features: dictionary of arrays with 'VLF', 'LF', 'HF' and 'LF_HF' per series (NaN for series too short).
+    """
+    n_series, max_len = nn.shape
+    in_series = np.arange(max_len) < lengths[:, None]
+    x = np.where(in_series, nn, 0.0)
+
+    # time of each interval, starting at 0 for the first one
+    times = np.cumsum(x, axis=1) / 1000
+    times -= times[:, :1]
+    duration = times[np.arange(n_series), np.maximum(lengths - 1, 0)]
+    n_resampled = np.ceil(duration * sampling_frequency).astype(np.int64)
+    n_resampled[lengths < 2] = 0
+
+    # resample every series in one np.interp call by shifting each one to its own time range
+    offset = np.ceil(duration.max() if n_series else 0) + 1
+    rows, cols = np.nonzero(in_series)
+    xp = rows * offset + times[rows, cols]
+    fp = x[rows, cols]
+    grid_rows = np.repeat(np.arange(n_series), n_resampled)
+    grid_idx = np.arange(n_resampled.sum()) - np.repeat(np.cumsum(n_resampled) - n_resampled, n_resampled)
+    resampled = np.interp(grid_rows * offset + grid_idx / float(sampling_frequency), xp, fp)
+
+    bands = {'VLF': vlf_band, 'LF': lf_band, 'HF': hf_band}
+    powers = {name: np.full(n_series, np.nan) for name in bands}
+
+    starts = np.cumsum(n_resampled) - n_resampled
+    for length in np.unique(n_resampled[n_resampled > 1]):
+        group = np.flatnonzero(n_resampled == length)
+        segments = resampled[starts[group][:, None] + np.arange(length)]
+        segments = segments - segments.mean(axis=1, keepdims=True)
+
+        freq, psd = signal.welch(segments, fs=sampling_frequency, window='hann', nperseg=min(256, length),
+                                 nfft=4096, axis=-1)
+        for name, (low, high) in bands.items():
+            band = (freq >= low) & (freq < high)
+            powers[name][group] = trapezoid(psd[:, band], freq[band], axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        powers['LF_HF'] = powers['LF'] / powers['HF']
+    return powers
+
+
+def compute_hrv_batch(nn_series, index=None, remove_ectopic=True):
+    """
+    Compute the 10 short-term HRV metrics for a batch of NN interval series in one call.
+
+    Replaces the per-series hrvanalysis pipeline of remove_ectopic_beats, interpolate_nan_values,
+    get_time_domain_features, get_frequency_domain_features(method='welch') and get_poincare_plot_features.
+
+    Args:
+    - nn_series: list of 1D arrays or lists of NN intervals in ms, e.g. one per patient or per window.
+    - index: index of the returned dataframe (e.g. the patient IDs). Default is a range index.
+    - remove_ectopic: whether to remove ectopic beats (malik rule) and interpolate them first. Default is True.
+
+    Returns:
+    - hrv_df: dataframe with the HRV_COLUMNS and the number of ectopic beats removed from each series.
+    """
+    #nothing to compute, e.g. when every patient is already up to date
+    if len(nn_series) == 0:
+        return pd.DataFrame(columns=HRV_COLUMNS + ['ectopic_beats'], index=index, dtype=float)
+
+    nn, lengths = pad_nn_series(nn_series)
+
+    if remove_ectopic:
+        nn, ectopic_count = remove_ectopic_beats_batch(nn, lengths)
+        nn = interpolate_nan_batch(nn, lengths)
+    else:
+        ectopic_count = np.zeros(len(lengths), dtype=np.int64)
+
+    features = time_domain_batch(nn, lengths)
+    features.update(frequency_domain_batch(nn, lengths))
+
+    hrv_df = pd.DataFrame({column: features[column] for column in HRV_COLUMNS}, index=index)
+    hrv_df['ectopic_beats'] = ectopic_count
+    return hrv_df
+
+
+def rolling_time_domain(nn, starts, stops):
+    """
+    Time domain and Poincare plot features of many windows nn[starts[k]:stops[k]] of one NN sequence.
+
+    Every window is scored from prefix sums of the intervals, their squares and their successive differences, so
+    the cost does not grow with the window length or the overlap between windows. The results are the same as
+    time_domain_batch on each window, up to rounding.
+
+    Args:
+    - nn: 1D array of NN intervals in ms without NaNs.
+    - starts, stops: start and end (exclusive) of each window in nn.
+
+    Returns:
+    - features: dictionary of arrays with 'MeanNN', 'SDNN', 'RMSSD', 'pNN50', 'SD1' and 'SD2' per window.
+    """
+    nn = np.asarray(nn, dtype=np.float64)
+    starts, stops = np.asarray(starts, dtype=np.int64), np.asarray(stops, dtype=np.int64)
+
+    def prefix(values):
+        return np.concatenate([[0], np.cumsum(values)])
+
+    # centre the intervals before squaring to keep the variance from prefix sums accurate
+    centre = nn.mean() if len(nn) else 0.0
+    x = nn - centre
+    x_sum, x2_sum = prefix(x), prefix(x ** 2)
+    diff = np.diff(nn)
+    d_sum, d2_sum, d50_sum = prefix(diff), prefix(diff ** 2), prefix(np.abs(diff) > 50)
+
+    n = (stops - starts).astype(np.float64)
+    n_diff = n - 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sum_x = x_sum[stops] - x_sum[starts]
+        mean_nn = centre + sum_x / n
+        sdnn = np.sqrt(np.maximum(x2_sum[stops] - x2_sum[starts] - sum_x ** 2 / n, 0) / (n - 1))
+
+        # the successive differences of a window are diff[start:stop-1]
+        diff_stops = np.maximum(stops - 1, starts)
+        sum_d = d_sum[diff_stops] - d_sum[starts]
+        sum_d2 = d2_sum[diff_stops] - d2_sum[starts]
+        rmssd = np.sqrt(sum_d2 / n_diff)
+        pnn50 = 100 * (d50_sum[diff_stops] - d50_sum[starts]) / n_diff
+
+        var_diff = np.maximum(sum_d2 - sum_d ** 2 / n_diff, 0) / (n_diff - 1)
+        sd1 = np.sqrt(var_diff * 0.5)
+        sd2 = np.sqrt(2 * sdnn ** 2 - 0.5 * var_diff)
+
+    return {'MeanNN': mean_nn, 'SDNN': sdnn, 'RMSSD': rmssd, 'pNN50': pnn50, 'SD1': sd1, 'SD2': sd2}
+
+
+def sliding_window_hrv(nn, starts, stops, index=None):
+    """
+    Compute the 10 short-term HRV metrics for many (possibly overlapping) windows of one NN sequence.
+
+    Time domain features come from rolling_time_domain and the Welch band powers from frequency_domain_batch on
+    the gathered windows. Ectopic beats are not removed here, so nn should already be cleaned (e.g. with
+    remove_ectopic_beats_batch and interpolate_nan_batch).
+
+    Args:
+    - nn: 1D array of NN intervals in ms without NaNs.
+    - starts, stops: start and end (exclusive) of each window in nn.
+    - index: index of the returned dataframe. Default is a range index.
+
+    Returns:
+    - hrv_df: dataframe with the HRV_COLUMNS for each window.
+    """
+    nn = np.asarray(nn, dtype=np.float64)
+    starts, stops = np.asarray(starts, dtype=np.int64), np.asarray(stops, dtype=np.int64)
+    lengths = stops - starts
+
+    #no window qualifies, e.g. a patient without a clean night
+    if len(starts) == 0:
+        return pd.DataFrame(columns=HRV_COLUMNS, index=index, dtype=float)
+
+    features = rolling_time_domain(nn, starts, stops)
+
+    # gather the windows into a NaN padded array for the batched Welch step
+    max_len = lengths.max() if len(lengths) else 0
+    positions = starts[:, None] + np.arange(max_len)
+    in_window = np.arange(max_len) < lengths[:, None]
+    windows = np.where(in_window, nn[np.minimum(positions, max(len(nn) - 1, 0))] if len(nn) else np.nan, np.nan)
+    features.update(frequency_domain_batch(windows, lengths))
+
+    return pd.DataFrame({column: features[column] for column in HRV_COLUMNS}, index=index)
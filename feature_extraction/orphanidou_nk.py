@@ -3,6 +3,11 @@ import numpy as np
 import matplotlib.pyplot as plt
 import neurokit2 as nk
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 from ecgdetectors import Detectors
 import neurokit2 as nk
 from hrvanalysis import remove_outliers, remove_ectopic_beats, interpolate_nan_values
@@ -79,29 +84,105 @@ def assess_feasibility(beats, fs):
 
 
 
-def calculate_template(sig, beats):
+def beat_wave_starts(beats, tol):
+
+    # first sample of the window of each beat (excluding the last) that lies between 0 and the last beat
+    starts = np.asarray(beats[:-1], dtype=np.int64) - tol
+    starts = starts[(starts >= 0) & (starts + 2*tol <= beats[-1])]
+    return starts
+
+
+def gather_beat_waves(sig, beats, tol):
+
+    # gather one row of 1+2*tol samples per beat
+    starts = beat_wave_starts(beats, tol)
+    idx = starts[:, None] + np.arange(1 + 2*tol)
+    waves = np.asarray(sig, dtype=float)[idx]
+    return waves
+
+
+def calculate_beat_ccs(waves, templ):
+
+    # Pearson coefficient of every beat against the template, following the steps of np.corrcoef
+    fact = waves.shape[1] - 1
+    waves_c = waves - waves.mean(axis=1, keepdims=True)
+    templ_c = templ - templ.mean()
+    cov = np.dot(waves_c, templ_c) * np.true_divide(1, fact)
+    std_waves = np.sqrt(np.einsum('ij,ij->i', waves_c, waves_c) * np.true_divide(1, fact))
+    std_templ = np.sqrt(np.dot(templ_c, templ_c) * np.true_divide(1, fact))
+    ccs = cov / std_waves / std_templ
+    ccs = np.clip(ccs, -1, 1)
+    return ccs
+
+
+def _sum_beat_waves_loop(sig, starts, width):
+
+    # sum of the beat windows, adding the beats in order
+    sum_waves = np.zeros(width)
+    for start in starts:
+        for i in range(width):
+            sum_waves[i] += sig[start + i]
+    return sum_waves
+
+
+def _beat_ccs_loop(sig, starts, width, templ):
+
+    # Pearson coefficient of every beat against the template, one beat at a time without temporary arrays
+    fact = width - 1
+    templ_mean = 0.0
+    for i in range(width):
+        templ_mean += templ[i]
+    templ_mean /= width
+    templ_ss = 0.0
+    for i in range(width):
+        templ_ss += (templ[i] - templ_mean) ** 2
+    std_templ = np.sqrt(templ_ss / fact)
+
+    ccs = np.zeros(len(starts))
+    for b in range(len(starts)):
+        start = starts[b]
+        wave_mean = 0.0
+        for i in range(width):
+            wave_mean += sig[start + i]
+        wave_mean /= width
+        cov = 0.0
+        wave_ss = 0.0
+        for i in range(width):
+            wave_c = sig[start + i] - wave_mean
+            cov += wave_c * (templ[i] - templ_mean)
+            wave_ss += wave_c * wave_c
+        cc = (cov / fact) / np.sqrt(wave_ss / fact) / std_templ
+        ccs[b] = min(max(cc, -1.0), 1.0)
+    return ccs
+
+
+if njit is not None:
+    _sum_beat_waves_loop = njit(_sum_beat_waves_loop)
+    _beat_ccs_loop = njit(_beat_ccs_loop)
+
+
+def calculate_template(sig, beats, use_numba=False):
     
     # find median rr interval
     med_rr_int = calculate_med_rr_int(beats)
     
     # find no. samples either side of beat
     tol = int(np.floor(med_rr_int/2))
-    sum_waves = np.zeros(1+2*tol)
-    no_beats_used = 0
-    for beat_no in range(0,len(beats)-1):
-            min_el = beats[beat_no]-tol
-            max_el = beats[beat_no]+tol
-            if min_el < 0 or max_el > beats[-1]:
-                continue
-            curr_samps = sig[min_el:max_el+1]
-            for i in range(0,len(sum_waves)):
-                sum_waves[i] += curr_samps[i]
-            no_beats_used +=1
+
+    # average the beat windows; with no usable beat this gives NaNs, as the loop over beats did
+    if use_numba and njit is not None:
+        starts = beat_wave_starts(beats, tol)
+        sum_waves = _sum_beat_waves_loop(np.asarray(sig, dtype=float), starts, 1 + 2*tol)
+        no_beats_used = len(starts)
+    else:
+        waves = gather_beat_waves(sig, beats, tol)
+        sum_waves = waves.sum(axis=0)
+        no_beats_used = len(waves)
     templ = sum_waves/no_beats_used
     return templ
 
 
-def calculate_cc(sig, beats, templ):
+def calculate_cc(sig, beats, templ, use_numba=False):
     
     # find median rr interval
     med_rr_int = calculate_med_rr_int(beats)
@@ -110,22 +191,15 @@ def calculate_cc(sig, beats, templ):
     tol = int(np.floor(med_rr_int/2))
     
     # calculate correlation coefficients for each beat
-    sum_cc = 0
-    no_beats_used = 0
-    for beat_no in range(0,len(beats)-1):
-            min_el = beats[beat_no]-tol
-            max_el = beats[beat_no]+tol
-            if min_el < 0 or max_el > beats[-1]:
-                continue
-            curr_samps = np.zeros(1+2*tol)
-            for i in range(0, 1+2*tol):
-                curr_samps[i] += sig[min_el+i]
-            temp = np.corrcoef(curr_samps, templ)
-            curr_cc = temp[0,1]
-            sum_cc = np.add(sum_cc, curr_cc)
-            no_beats_used +=1
-            
-    # find average correlation coefficient
+    if use_numba and njit is not None:
+        ccs = _beat_ccs_loop(np.asarray(sig, dtype=float), beat_wave_starts(beats, tol), 1 + 2*tol, np.asarray(templ, dtype=float))
+    else:
+        ccs = calculate_beat_ccs(gather_beat_waves(sig, beats, tol), templ)
+
+    # find average correlation coefficient, summing in beat order; with no usable beat this raises
+    # ZeroDivisionError, as the loop over beats did
+    sum_cc = np.cumsum(ccs)[-1] if len(ccs) else 0
+    no_beats_used = len(ccs)
     cc = sum_cc/no_beats_used
     return cc
 
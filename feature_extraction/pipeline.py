@@ -0,0 +1,186 @@
+import os
+import json
+import uuid
+import hashlib
+import inspect
+
+from feature_store import group_file, read_group, KEY
+
+
+#upstream files each feature stage reads for a patient, relative to the data folder
+STAGE_INPUTS = {
+    'steps': ['steps/counts/{numeric_id}_gait_hourly.csv', 'hr_values/{patient_id}.npy'],
+    'activity_hr': ['hr_values/{patient_id}.npy', 'activity_class/{patient_id}_combined-timeSeries.csv.gz'],
+    'short_term_hrv': ['hr_values/{patient_id}.npy', 'activity_class/{patient_id}_combined-timeSeries.csv.gz',
+                       'bdf_files/{file_name}/{patient_id}/ECG_A.parquet', 'beat_index/{patient_id}.npz'],
+}
+
+
+def file_fingerprint(file, content_hash=False):
+    """
+    Fingerprint of an input file, which changes whenever the file is rewritten.
+
+    Args:
+    - file: path of the file.
+    - content_hash: if True, use the SHA-256 of the contents, which survives copies and touches but reads the whole
+      file. Default is False, which uses the size and modification time.
+
+    Returns:
+    - fingerprint: string fingerprint, or None if the file does not exist.
+    """
+    if not os.path.exists(file):
+        return None
+    if not content_hash:
+        stat = os.stat(file)
+        return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+    digest = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return f'sha256:{digest.hexdigest()}'
+
+
+def code_version(*modules):
+    """
+    Version of the extraction code: the SHA-256 of the source files of the given modules.
+
+    Args:
+    - modules: imported modules the stage depends on, e.g. extraction_functions and hrv_metrics.
+
+    Returns:
+    - version: hex digest that changes whenever any of the source files change.
+    """
+    digest = hashlib.sha256()
+    for module in modules:
+        with open(inspect.getsourcefile(module), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def stage_input_files(stage, path, patient_id, file_name):
+    """
+    Upstream files of one patient for a feature stage listed in STAGE_INPUTS.
+    """
+    numeric_id = str(int(patient_id.lstrip('R')))
+    return [os.path.join(path, template.format(patient_id=patient_id, numeric_id=numeric_id, file_name=file_name))
+            for template in STAGE_INPUTS[stage]]
+
+
+def manifest_file(store_dir, stage):
+    """
+    Path of the manifest recording what each patient of a stage was computed from.
+    """
+    return os.path.join(store_dir, '_manifest', f'{stage}.json')
+
+
+def load_manifest(store_dir, stage):
+    """
+    Manifest of a stage as a dictionary mapping each Patient ID to its signature, empty if the stage never ran.
+    """
+    file = manifest_file(store_dir, stage)
+    if not os.path.exists(file):
+        return {}
+    with open(file) as f:
+        return json.load(f)
+
+
+def save_manifest(store_dir, stage, manifest):
+    """
+    Write the manifest of a stage atomically, as write_group does for the feature groups.
+    """
+    file = manifest_file(store_dir, stage)
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    tmp_file = f'{file}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, file)
+
+
+def patient_signature(input_files, code, params=None, content_hash=False):
+    """
+    Signature of one patient's feature output: the fingerprints of its inputs, the code version and the parameters.
+
+    Args:
+    - input_files: upstream files the output is computed from.
+    - code: the code version from code_version.
+    - params: JSON-serialisable values the output also depends on (e.g. the hours of data collected). Default is None.
+    - content_hash: whether to fingerprint the inputs by content instead of size and modification time.
+
+    Returns:
+    - signature: dictionary that is equal for two runs only if they would compute the same output.
+    """
+    return {
+        'inputs': {os.path.basename(file): file_fingerprint(file, content_hash) for file in input_files},
+        'code': code,
+        'params': params,
+    }
+
+
+def stale_patients(df, stage, store_dir, path, code, params_columns=None, content_hash=False, force=False):
+    """
+    Find the patients of a stage whose features have to be recomputed.
+
+    A patient is stale if it is not in the stage's manifest or its feature group, or if any input file, the code
+    version or the parameters differ from those recorded when its features were last written.
+
+    Args:
+    - df: dataframe with 'Patient ID' and 'file_name' columns and any params_columns.
+    - stage: name of the stage, which is also the name of its feature group.
+    - store_dir: folder of the feature store.
+    - path: data folder the STAGE_INPUTS are relative to.
+    - code: the code version from code_version.
+    - params_columns: columns of df the stage's output also depends on. Default is None.
+    - content_hash: whether to fingerprint the inputs by content. Default is False (size and modification time).
+    - force: if True, every patient is stale. Default is False.
+
+    Returns:
+    - stale: list of the Patient IDs to recompute.
+    - signatures: dictionary mapping each Patient ID of df to its current signature, to be passed to
+      record_patients once the stale patients have been written.
+    """
+    manifest = load_manifest(store_dir, stage)
+    stored = set()
+    if os.path.exists(group_file(store_dir, stage)):
+        stored = set(read_group(stage, store_dir, columns=[])[KEY])
+
+    stale = []
+    signatures = {}
+    for _, row in df.iterrows():
+        patient_id = row[KEY]
+        params = None if params_columns is None else {column: _json_value(row[column]) for column in params_columns}
+        signatures[patient_id] = patient_signature(stage_input_files(stage, path, patient_id, row['file_name']),
+                                                   code, params, content_hash)
+
+        if force or patient_id not in stored or manifest.get(patient_id) != signatures[patient_id]:
+            stale.append(patient_id)
+
+    print(f"{stage}: {len(stale)} of {len(df)} patients to compute", flush=True)
+    return stale, signatures
+
+
+def record_patients(store_dir, stage, signatures, patient_ids):
+    """
+    Record in the manifest of a stage the signatures of the patients whose features have just been written.
+
+    Args:
+    - store_dir: folder of the feature store.
+    - stage: name of the stage.
+    - signatures: the signatures returned by stale_patients.
+    - patient_ids: the patients whose features were written.
+    """
+    manifest = load_manifest(store_dir, stage)
+    for patient_id in patient_ids:
+        manifest[patient_id] = signatures[patient_id]
+    save_manifest(store_dir, stage, manifest)
+
+
+def _json_value(value):
+    """
+    Convert a dataframe value to a JSON-serialisable value so it compares equal after a round trip.
+    """
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    return value if isinstance(value, (int, float, str, bool, type(None))) else str(value)
@@ -0,0 +1,169 @@
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+
+def _scale(scaler, X):
+    """
+    Scale X with a fitted StandardScaler, or return it as a float array if scaler is None.
+    """
+    if scaler is None:
+        return np.asarray(X, dtype=float)
+    return scaler.transform(X)
+
+
+def linear_shap(model, scaler, X, background):
+    """
+    Exact SHAP values of a linear model on standardized features.
+
+    With independent features, the SHAP value of feature j for a patient is coef_j * (x_j - mean of x_j over the
+    background), which is what shap.Explainer(model, background) returns for a linear model.
+
+    Args:
+    - model: fitted linear model with coef_ and intercept_ (e.g. Lasso or LassoCV).
+    - scaler: the fitted StandardScaler the model was trained with, or None if X and background are already scaled.
+    - X: patients to explain (unscaled if a scaler is given).
+    - background: patients defining the expected value, usually the training set of the fold.
+
+    Returns:
+    - shap_values: array of shape (n_patients, n_features).
+    - base_value: expected model output over the background, so that base_value + shap_values.sum(axis=1) equals
+      the model prediction.
+    """
+    coef = np.asarray(model.coef_, dtype=float)
+    background_mean = _scale(scaler, background).mean(axis=0)
+
+    shap_values = (_scale(scaler, X) - background_mean) * coef
+    base_value = model.intercept_ + background_mean @ coef
+    return shap_values, base_value
+
+
+def group_shap(shap_values, features, feature_groups, other='Other'):
+    """
+    SHAP values of feature groups.
+
+    For a linear model the SHAP value of a group of features is the sum of the SHAP values of its features.
+    Features that are not in any group are summed in the other column.
+
+    Args:
+    - shap_values: array of shape (n_patients, n_features) from linear_shap.
+    - features: names of the columns of shap_values.
+    - feature_groups: dictionary mapping each group name to its list of features.
+    - other: name of the column of features not in any group, or None to drop them. Default is 'Other'.
+
+    Returns:
+    - group_values: dataframe with one column per group.
+    """
+    shap_values = np.asarray(shap_values, dtype=float)
+    features = list(features)
+
+    #membership matrix of shape (n_features, n_groups), so the group sums are one matrix product
+    groups = list(feature_groups)
+    membership = np.array([[feature in feature_groups[group] for group in groups] for feature in features], dtype=float)
+    if other is not None:
+        membership = np.column_stack([membership, membership.sum(axis=1) == 0])
+        groups.append(other)
+
+    return pd.DataFrame(shap_values @ membership, columns=groups)
+
+
+def shap_importance(shap_values, features, feature_groups, other='Other'):
+    """
+    Mean absolute SHAP value of each feature, with the group it belongs to.
+
+    Args:
+    - shap_values: array of shape (n_patients, n_features) from linear_shap.
+    - features: names of the columns of shap_values.
+    - feature_groups: dictionary mapping each group name to its list of features.
+    - other: group assigned to features not in any group. Default is 'Other'.
+
+    Returns:
+    - importance: dataframe with 'Feature', 'Mean Absolute SHAP Value' and 'Group' columns, sorted by importance.
+    """
+    importance = pd.DataFrame({
+        'Feature': list(features),
+        'Mean Absolute SHAP Value': np.abs(np.asarray(shap_values, dtype=float)).mean(axis=0)
+    })
+    importance['Group'] = importance['Feature'].apply(
+        lambda x: next((group for group, feat_list in feature_groups.items() if x in feat_list), other)
+    )
+    return importance.sort_values(by='Mean Absolute SHAP Value', ascending=False, ignore_index=True)
+
+
+def resampled_shap(results, df, feature_sets, splits, label, feature_groups, other='Other'):
+    """
+    Mean absolute SHAP values of every feature and feature group on the test set of every resampled split.
+
+    The coefficients and scaler statistics stored by nested_cv.run_resampled_cv are reused, so no model is refitted.
+    The background of each split is its training set.
+
+    Args:
+    - results: dataframe returned by nested_cv.run_resampled_cv.
+    - df: the dataframe the results were computed on.
+    - feature_sets: dictionary mapping each model label to its list of features (or to {"features": [...]}).
+    - splits: the splits the results were computed on.
+    - label: the feature set to explain.
+    - feature_groups: dictionary mapping each group name to its list of features.
+    - other: name of the group of features not in any group. Default is 'Other'.
+
+    Returns:
+    - feature_importance: dataframe with one row per split and one column per feature.
+    - group_importance: dataframe with one row per split and one column per group.
+    """
+    params = feature_sets[label]
+    features = params["features"] if isinstance(params, dict) else list(params)
+    X = df[features].to_numpy(dtype=float)
+
+    rows = results[results["feature_set"] == label].set_index(["scheme", "repeat", "fold"])
+
+    feature_rows, group_rows, index = [], [], []
+    for split in splits:
+        key = (split["scheme"], split["repeat"], split["fold"])
+        row = rows.loc[key]
+
+        X_scaled = (X - row["scale_mean"]) / row["scale_std"]
+        shap_values = (X_scaled[split["test_index"]] - X_scaled[split["train_index"]].mean(axis=0)) * row["coef"]
+
+        feature_rows.append(np.abs(shap_values).mean(axis=0))
+        group_rows.append(group_shap(shap_values, features, feature_groups, other).abs().mean(axis=0))
+        index.append(key)
+
+    index = pd.MultiIndex.from_tuples(index, names=["scheme", "repeat", "fold"])
+    return pd.DataFrame(feature_rows, index=index, columns=features), pd.DataFrame(group_rows, index=index)
+
+
+def summary_plot(shap_values, X, feature_names=None, max_display=20, cmap='coolwarm'):
+    """
+    Beeswarm-style summary plot of SHAP values, one row per feature coloured by the feature value.
+
+    Args:
+    - shap_values: array of shape (n_patients, n_features).
+    - X: feature values of the same patients, used for the colours.
+    - feature_names: labels of the features. Default is the columns of X if it is a dataframe.
+    - max_display: number of features shown, the most important at the top. Default is 20.
+    - cmap: colormap of the feature values. Default is 'coolwarm'.
+    """
+    shap_values = np.asarray(shap_values, dtype=float)
+    if feature_names is None:
+        feature_names = list(X.columns) if isinstance(X, pd.DataFrame) else [f'Feature {i}' for i in range(shap_values.shape[1])]
+    X = np.asarray(X, dtype=float)
+
+    order = np.argsort(np.abs(shap_values).mean(axis=0))[-max_display:]
+    rng = np.random.default_rng(0)
+
+    ax = plt.gca()
+    for row, j in enumerate(order):
+        #scale the colours of each feature to its own 5th-95th percentile range
+        low, high = np.nanpercentile(X[:, j], [5, 95])
+        colours = np.clip((X[:, j] - low) / (high - low), 0, 1) if high > low else np.full(len(X), 0.5)
+        jitter = rng.uniform(-0.3, 0.3, len(shap_values))
+        points = ax.scatter(shap_values[:, j], row + jitter, c=colours, cmap=cmap, vmin=0, vmax=1, s=12, alpha=0.8)
+
+    ax.axvline(0, color='grey', linewidth=0.8)
+    ax.set_yticks(range(len(order)))
+    ax.set_yticklabels([feature_names[j] for j in order])
+    ax.set_xlabel('SHAP value (impact on model output)')
+
+    colourbar = plt.colorbar(points, ax=ax, ticks=[0, 1], aspect=40)
+    colourbar.set_ticklabels(['Low', 'High'])
+    colourbar.set_label('Feature value')
@@ -0,0 +1,360 @@
+import os
+import numpy as np
+import pandas as pd
+import joblib
+from joblib import Parallel, delayed
+from sklearn.linear_model import LassoCV
+from sklearn.preprocessing import StandardScaler
+from sklearn.model_selection import KFold
+from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+from scipy.stats import pearsonr, t as t_dist
+
+
+#metrics reported for every outer fold
+METRICS = ["Correlation", "R²", "MAE", "RMSE", "APE"]
+
+#metrics where a lower value means a better model
+LOWER_IS_BETTER = ["MAE", "RMSE", "APE"]
+
+#fold results already computed in this session, keyed by (feature set hash, split hash)
+_fold_cache = {}
+
+
+def fold_metrics(y_test, y_pred):
+    """
+    Calculate the evaluation metrics of one outer fold.
+
+    Args:
+    - y_test: measured values of the test set.
+    - y_pred: predicted values of the test set.
+
+    Returns:
+    - metrics: dictionary with the Correlation, R², MAE, RMSE and APE (in %) of the fold.
+    """
+    y_test = np.asarray(y_test, dtype=float)
+    y_pred = np.asarray(y_pred, dtype=float)
+
+    correlation, _ = pearsonr(y_test, y_pred)
+    return {
+        "Correlation": correlation,
+        "R²": r2_score(y_test, y_pred),
+        "MAE": mean_absolute_error(y_test, y_pred),
+        "RMSE": np.sqrt(mean_squared_error(y_test, y_pred)),
+        "APE": np.mean(np.abs((y_test - y_pred) / y_test) * 100),
+    }
+
+
+def lasso_alpha_grid(X, y, eps=1e-3, n_alphas=100):
+    """
+    Alpha path of one outer training set, built as LassoCV builds its own grid.
+
+    The grid runs from the smallest alpha that sets every coefficient to zero on (X, y) down to eps times that
+    value, evenly spaced on a log scale and in decreasing order, so along the path each inner fit warm starts
+    from the coefficients of the previous alpha. It is built from the training rows only, so the held-out rows
+    do not shape the hyperparameter search.
+
+    Args:
+    - X: scaled predictors of the training set.
+    - y: target values of the training set.
+    - eps: ratio of the smallest to the largest alpha. Default is 1e-3.
+    - n_alphas: number of alphas on the path. Default is 100.
+
+    Returns:
+    - alphas: decreasing array of alphas.
+    """
+    X = np.asarray(X, dtype=float)
+    y = np.asarray(y, dtype=float)
+    alpha_max = np.max(np.abs((X - X.mean(axis=0)).T @ (y - y.mean()))) / len(y)
+    return np.logspace(np.log10(alpha_max), np.log10(alpha_max * eps), num=n_alphas)
+
+
+def fit_lasso_fold(X, y, train_index, test_index, inner_cv=5, random_state=42):
+    """
+    Fit and evaluate the LASSO model of one outer fold.
+
+    The alpha is chosen by an inner LassoCV over the alpha path of the outer training set, and the model LassoCV
+    refits on the whole training set at that alpha is used directly for prediction.
+
+    Args:
+    - X: scaled predictors of every patient.
+    - y: target values of every patient.
+    - train_index, test_index: rows of the outer training and test sets.
+    - inner_cv: number of inner folds. Default is 5.
+    - random_state: random state of LassoCV. Default is 42.
+
+    Returns:
+    - record: dictionary with the selected alpha, the number of non-zero coefficients and the fold metrics.
+    - model: the fitted LassoCV model.
+    """
+    alphas = lasso_alpha_grid(X[train_index], y[train_index])
+    model = LassoCV(alphas=alphas, cv=inner_cv, random_state=random_state)
+    model.fit(X[train_index], y[train_index])
+
+    y_pred = model.predict(X[test_index])
+    record = {"alpha": model.alpha_, "n_selected": int(np.sum(model.coef_ != 0))}
+    record.update(fold_metrics(y[test_index], y_pred))
+    return record, model
+
+
+def run_nested_cv(df, feature_sets, target='vo2peak_measured', n_splits=5, random_state=42, inner_cv=5,
+                  scale_within_fold=False, n_jobs=-1, return_models=False):
+    """
+    Run the nested cross-validation of the LASSO model for several feature sets in parallel.
+
+    Every feature set is evaluated on the same outer KFold splits, so the fold-wise results are paired, and all
+    (feature set, fold) fits run in parallel with joblib.
+
+    Args:
+    - df: dataframe with the features and the target.
+    - feature_sets: dictionary mapping each model label to its list of features (or to {"features": [...]}).
+    - target: name of the target column. Default is 'vo2peak_measured'.
+    - n_splits: number of outer folds. Default is 5.
+    - random_state: random state of the outer KFold and of LassoCV. Default is 42.
+    - inner_cv: number of inner folds used to choose alpha. Default is 5.
+    - scale_within_fold: if True, fit the StandardScaler on each outer training set only. Default is False,
+      which scales on all patients as the original analysis did.
+    - n_jobs: number of parallel jobs. Default is -1 (all CPUs).
+    - return_models: if True, also return the fitted model, scaler and split of every fold. Default is False.
+
+    Returns:
+    - fold_df: dataframe with one row per feature set and fold (alpha, number of selected features and METRICS).
+    - models (only if return_models): dictionary mapping (label, fold) to a dictionary with the 'model',
+      'scaler', 'features', 'train_index' and 'test_index' of the fold.
+    """
+    y = df[target].to_numpy(dtype=float)
+    splits = list(KFold(n_splits=n_splits, shuffle=True, random_state=random_state).split(df))
+
+    tasks = []
+    for label, params in feature_sets.items():
+        features = params["features"] if isinstance(params, dict) else list(params)
+        X = df[features].to_numpy(dtype=float)
+        global_scaler = StandardScaler().fit(X)
+
+        for fold, (train_index, test_index) in enumerate(splits):
+            # Scale the features on all patients, or on the outer training set only
+            scaler = StandardScaler().fit(X[train_index]) if scale_within_fold else global_scaler
+            X_scaled = scaler.transform(X)
+            tasks.append((label, fold, features, scaler, X_scaled, train_index, test_index))
+
+    fits = Parallel(n_jobs=n_jobs)(
+        delayed(fit_lasso_fold)(X_scaled, y, train_index, test_index, inner_cv, random_state)
+        for _, _, _, _, X_scaled, train_index, test_index in tasks
+    )
+
+    records = []
+    models = {}
+    for (label, fold, features, scaler, _, train_index, test_index), (record, model) in zip(tasks, fits):
+        records.append({"feature_set": label, "fold": fold, **record})
+        models[(label, fold)] = {"model": model, "scaler": scaler, "features": features,
+                                 "train_index": train_index, "test_index": test_index}
+
+    fold_df = pd.DataFrame(records, columns=["feature_set", "fold", "alpha", "n_selected"] + METRICS)
+    if return_models:
+        return fold_df, models
+    return fold_df
+
+
+def paired_differences(fold_df, model_a="With HRV", model_b="Without HRV"):
+    """
+    Fold-wise differences of every metric between two feature sets evaluated on the same splits.
+
+    Args:
+    - fold_df: dataframe returned by run_nested_cv.
+    - model_a, model_b: labels of the two feature sets; the differences are model_a - model_b.
+
+    Returns:
+    - differences: dataframe with one row per fold and one column per metric.
+    """
+    by_model = fold_df.set_index(["feature_set", "fold"])[METRICS]
+    return by_model.loc[model_a] - by_model.loc[model_b]
+
+
+def repeated_kfold_splits(n_samples, n_splits=5, n_repeats=100, random_state=42):
+    """
+    Outer splits of a repeated K-fold cross-validation.
+
+    Repeat r uses KFold(shuffle=True, random_state=random_state + r), so repeat 0 is the split of run_nested_cv and
+    the first repeats stay the same when n_repeats is increased.
+
+    Args:
+    - n_samples: number of patients.
+    - n_splits: number of folds per repeat. Default is 5.
+    - n_repeats: number of repeats. Default is 100.
+    - random_state: random state of the first repeat. Default is 42.
+
+    Returns:
+    - splits: list of dictionaries with the 'scheme', 'repeat', 'fold', 'train_index' and 'test_index' of each split.
+    """
+    splits = []
+    for repeat in range(n_repeats):
+        kf = KFold(n_splits=n_splits, shuffle=True, random_state=random_state + repeat)
+        for fold, (train_index, test_index) in enumerate(kf.split(np.zeros(n_samples))):
+            splits.append({"scheme": "repeated_kfold", "repeat": repeat, "fold": fold,
+                           "train_index": train_index, "test_index": test_index})
+    return splits
+
+
+def bootstrap_splits(n_samples, n_boot=200, random_state=42):
+    """
+    Bootstrap splits: the model is trained on a resample drawn with replacement and tested on the out-of-bag patients.
+
+    Resample b is drawn from its own generator seeded with (random_state, b), so the first resamples stay the same
+    when n_boot is increased.
+
+    Args:
+    - n_samples: number of patients.
+    - n_boot: number of bootstrap resamples. Default is 200.
+    - random_state: random state of the resamples. Default is 42.
+
+    Returns:
+    - splits: list of dictionaries with the 'scheme', 'repeat', 'fold', 'train_index' and 'test_index' of each split.
+    """
+    splits = []
+    for b in range(n_boot):
+        rng = np.random.default_rng([random_state, b])
+        train_index = np.sort(rng.integers(0, n_samples, n_samples))
+        test_index = np.setdiff1d(np.arange(n_samples), train_index)
+        splits.append({"scheme": "bootstrap", "repeat": b, "fold": 0,
+                       "train_index": train_index, "test_index": test_index})
+    return splits
+
+
+def evaluate_split(X, y, train_index, test_index, inner_cv=5, random_state=42, scale_within_fold=False):
+    """
+    Fit and evaluate the LASSO model of one split, returning only what is needed to summarise it.
+
+    Args:
+    - X: unscaled predictors of every patient.
+    - y: target values of every patient.
+    - train_index, test_index: rows of the training and test sets.
+    - inner_cv: number of inner folds. Default is 5.
+    - random_state: random state of LassoCV. Default is 42.
+    - scale_within_fold: if True, fit the StandardScaler on the training set only. Default is False.
+
+    Returns:
+    - record: dictionary with the split sizes, selected alpha, number of non-zero coefficients, fold metrics, and
+      the 'coef', 'intercept', 'scale_mean' and 'scale_std' of the fitted model.
+    """
+    scaler = StandardScaler().fit(X[train_index] if scale_within_fold else X)
+    record, model = fit_lasso_fold(scaler.transform(X), y, train_index, test_index, inner_cv, random_state)
+    record.update({"n_train": len(train_index), "n_test": len(test_index), "coef": model.coef_,
+                   "intercept": model.intercept_, "scale_mean": scaler.mean_, "scale_std": scaler.scale_})
+    return record
+
+
+def run_resampled_cv(df, feature_sets, splits, target='vo2peak_measured', inner_cv=5, random_state=42,
+                     scale_within_fold=False, n_jobs=-1, cache_dir=None):
+    """
+    Evaluate the LASSO pipeline of every feature set on every split, in parallel and memoized.
+
+    Every feature set is evaluated on the same splits, so the results are paired. A split result is cached under
+    (feature set hash, split hash). The feature set hash covers the features, the data and the model settings.
+    Cached results are reused, so adding repeats or resamples only computes the new splits. Results are kept for
+    the session and, if cache_dir is given, also saved to disk so later sessions can reuse them.
+
+    Args:
+    - df: dataframe with the features and the target.
+    - feature_sets: dictionary mapping each model label to its list of features (or to {"features": [...]}).
+    - splits: list of splits from repeated_kfold_splits and/or bootstrap_splits.
+    - target: name of the target column. Default is 'vo2peak_measured'.
+    - inner_cv: number of inner folds used to choose alpha. Default is 5.
+    - random_state: random state of LassoCV. Default is 42.
+    - scale_within_fold: if True, fit the StandardScaler on each training set only. Default is False.
+    - n_jobs: number of parallel jobs. Default is -1 (all CPUs).
+    - cache_dir: folder to save the split results in. Default is None (session cache only).
+
+    Returns:
+    - results: dataframe with one row per feature set and split (scheme, repeat, fold, split sizes, alpha, number
+      of selected features and METRICS). The coefficients of each split are kept in the 'coef', 'intercept',
+      'scale_mean' and 'scale_std' columns.
+    """
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    y = df[target].to_numpy(dtype=float)
+    split_keys = [joblib.hash((split["train_index"], split["test_index"])) for split in splits]
+
+    records = {}
+    tasks = []
+    for label, params in feature_sets.items():
+        features = params["features"] if isinstance(params, dict) else list(params)
+        X = df[features].to_numpy(dtype=float)
+        set_key = joblib.hash((features, X, y, inner_cv, random_state, scale_within_fold))
+
+        for split, split_key in zip(splits, split_keys):
+            key = (set_key, split_key)
+            cache_file = None if cache_dir is None else os.path.join(cache_dir, f"{set_key}_{split_key}.pkl")
+            if key not in _fold_cache and cache_file is not None and os.path.exists(cache_file):
+                _fold_cache[key] = joblib.load(cache_file)
+
+            if key in _fold_cache:
+                records[(label, split_key)] = _fold_cache[key]
+            else:
+                tasks.append((label, split_key, key, cache_file, X, split))
+
+    print(f"{len(tasks)} splits to fit, {len(records)} reused from the cache", flush=True)
+
+    fits = Parallel(n_jobs=n_jobs)(
+        delayed(evaluate_split)(X, y, split["train_index"], split["test_index"], inner_cv, random_state,
+                                scale_within_fold)
+        for _, _, _, _, X, split in tasks
+    )
+
+    for (label, split_key, key, cache_file, _, _), record in zip(tasks, fits):
+        _fold_cache[key] = record
+        records[(label, split_key)] = record
+        if cache_file is not None:
+            joblib.dump(record, cache_file)
+
+    rows = []
+    for label in feature_sets:
+        for split, split_key in zip(splits, split_keys):
+            rows.append({"feature_set": label, "scheme": split["scheme"], "repeat": split["repeat"],
+                         "fold": split["fold"], **records[(label, split_key)]})
+
+    columns = ["feature_set", "scheme", "repeat", "fold", "n_train", "n_test", "alpha", "n_selected"] + METRICS
+    return pd.DataFrame(rows, columns=columns + ["coef", "intercept", "scale_mean", "scale_std"])
+
+
+def paired_ci(results, model_a="With HRV", model_b="Without HRV", level=0.95):
+    """
+    Paired confidence intervals of the difference of every metric between two feature sets.
+
+    For repeated K-fold the differences of all R x K folds are combined with the corrected resampled t-test of
+    Nadeau and Bengio. Its variance is inflated by n_test / n_train to account for the overlap of the training
+    sets, as the plain fold-wise SD is too optimistic. For bootstrap the interval is the percentile interval of
+    the out-of-bag differences.
+
+    Args:
+    - results: dataframe returned by run_resampled_cv.
+    - model_a, model_b: labels of the two feature sets; the differences are model_a - model_b.
+    - level: confidence level. Default is 0.95.
+
+    Returns:
+    - summary: dataframe with one row per scheme and metric with the mean of both models, the mean difference,
+      its confidence interval and the fraction of splits where model_a is better.
+    """
+    rows = []
+    for scheme, scheme_df in results.groupby("scheme", sort=False):
+        by_model = scheme_df.set_index(["feature_set", "repeat", "fold"])
+        a = by_model.loc[model_a]
+        b = by_model.loc[model_b].loc[a.index]
+
+        for metric in METRICS:
+            diff = (a[metric] - b[metric]).to_numpy()
+            diff = diff[~np.isnan(diff)]
+            mean_diff = np.mean(diff)
+
+            if scheme == "repeated_kfold":
+                corrected_var = (1 / len(diff) + np.mean(a["n_test"] / a["n_train"])) * np.var(diff, ddof=1)
+                half_width = t_dist.ppf(0.5 + level / 2, len(diff) - 1) * np.sqrt(corrected_var)
+                ci_low, ci_high = mean_diff - half_width, mean_diff + half_width
+            else:
+                ci_low, ci_high = np.percentile(diff, [50 * (1 - level), 50 * (1 + level)])
+
+            better = diff < 0 if metric in LOWER_IS_BETTER else diff > 0
+            rows.append({"scheme": scheme, "metric": metric, f"mean {model_a}": np.nanmean(a[metric]),
+                         f"mean {model_b}": np.nanmean(b[metric]), "mean_diff": mean_diff, "ci_low": ci_low,
+                         "ci_high": ci_high, f"frac {model_a} better": np.mean(better), "n": len(diff)})
+
+    return pd.DataFrame(rows)
@@ -0,0 +1,40 @@
+import os
+import sys
+import importlib.util
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HR_DIR = os.path.join(ROOT, 'HR')
+
+#the feature extraction and model development modules import each other by name, as the notebooks do
+for folder in ['feature_extraction', 'model_development']:
+    sys.path.insert(0, os.path.join(ROOT, folder))
+
+
+def load_hr_module(name):
+    """
+    Import a module of the HR folder as 'hr_<name>'.
+
+    HR/orphanidou_nk.py and feature_extraction/orphanidou_nk.py share a name, so the HR modules are loaded from
+    their files with the HR folder first on the path, and the HR versions of their sibling modules are dropped
+    from sys.modules again afterwards.
+    """
+    module_name = f'hr_{name}'
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+
+    siblings = ['orphanidou_nk', 'ecg_stream']
+    saved = {sibling: sys.modules.pop(sibling) for sibling in siblings if sibling in sys.modules}
+    sys.path.insert(0, HR_DIR)
+    try:
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(HR_DIR, f'{name}.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(HR_DIR)
+        for sibling in siblings:
+            sys.modules.pop(sibling, None)
+        sys.modules.update(saved)
+
+    sys.modules[module_name] = module
+    return module
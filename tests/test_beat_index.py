@@ -0,0 +1,57 @@
+import numpy as np
+import neurokit2 as nk
+
+from conftest import load_hr_module
+from extraction_functions import load_beat_index, beat_index_nn
+from orphanidou_nk import extract_nn
+
+
+mainHR_script = load_hr_module('mainHR_script')
+hr_orphanidou_nk = load_hr_module('orphanidou_nk')
+
+FS = 250
+WINDOW_LEN = 10 * FS
+
+
+def window_nn(beats, quality, first=0, last=None):
+    """
+    Reference NN intervals: np.diff of the beats of every acceptable window, in seconds.
+    """
+    nn = [np.diff(beats[i]) / FS for i in range(first, len(beats) if last is None else last) if quality[i] == 1]
+    return np.concatenate(nn) if nn else np.zeros(0)
+
+
+def test_round_trip(tmp_path):
+    beats = [[100, 350, 600, 850], [], [20, 2400], [5, 260, 515, 770, 1025, 1280], [1000]]
+    quality = np.array([1, 0, 1, 0, 1])
+    hr = np.array([60.0, 0.0, 25.5, 0.0, 12.0])
+    file = tmp_path / 'R001.npz'
+
+    mainHR_script.save_beat_index(str(file), beats, quality, hr, FS, WINDOW_LEN)
+    beat_index = load_beat_index(str(file))
+
+    assert beat_index['fs'] == FS and beat_index['window_len'] == WINDOW_LEN
+    np.testing.assert_array_equal(beat_index['quality'], quality)
+    np.testing.assert_array_equal(beat_index['hr'], hr.astype(np.float32))
+    for i, window_beats in enumerate(beats):
+        positions = beat_index['beat_positions'][beat_index['window_offsets'][i]:beat_index['window_offsets'][i + 1]]
+        np.testing.assert_array_equal(positions, np.array(window_beats, dtype=np.int64) + i * WINDOW_LEN)
+
+    # no interval is formed across window boundaries or from windows of unacceptable quality
+    np.testing.assert_array_equal(beat_index_nn(beat_index), window_nn(beats, quality))
+    np.testing.assert_array_equal(beat_index_nn(beat_index, start_s=10, duration_s=20), window_nn(beats, quality, 1, 3))
+    assert len(beat_index_nn(beat_index, start_s=50)) == 0
+
+
+def test_nn_match_extract_nn(tmp_path):
+    ecg = nk.ecg_simulate(duration=120, sampling_rate=FS, heart_rate=65, noise=0.05, random_state=1)
+    ecg = ecg[:len(ecg)//WINDOW_LEN*WINDOW_LEN].reshape(-1, WINDOW_LEN)
+    quality, hr, beats = hr_orphanidou_nk.assess_qual_hr_batch(ecg, FS, 0.66)
+    file = tmp_path / 'R002.npz'
+
+    mainHR_script.save_beat_index(str(file), beats, quality, hr, FS, WINDOW_LEN)
+    beat_index = load_beat_index(str(file))
+
+    expected = np.concatenate([np.asarray(extract_nn(window, FS, 0.66)[0], dtype=float) for window in ecg])
+    assert quality.sum() > 0
+    np.testing.assert_allclose(beat_index_nn(beat_index), expected)
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from feature_store import (KEY, write_group, upsert_group, read_group, list_groups, load_features, import_csv,
+                           group_file)
+
+
+def cohort():
+    return pd.DataFrame({KEY: ['R001', 'R002', 'R003'], 'file_name': ['a', 'b', 'c'], 'Wear time': [24.0, 30.5, 48.0]})
+
+
+def test_round_trip(tmp_path):
+    df = cohort()
+    write_group(df, 'cohort', tmp_path)
+
+    pd.testing.assert_frame_equal(read_group('cohort', tmp_path), df)
+    pd.testing.assert_frame_equal(read_group('cohort', tmp_path, columns=['Wear time']), df[[KEY, 'Wear time']])
+    assert list_groups(tmp_path) == ['cohort']
+    assert [file.name for file in tmp_path.iterdir()] == ['cohort.parquet']
+
+
+def test_write_rejects_bad_keys(tmp_path):
+    df = cohort()
+    with pytest.raises(ValueError, match='duplicated'):
+        write_group(pd.concat([df, df.iloc[:1]]), 'cohort', tmp_path)
+    with pytest.raises(ValueError, match='without'):
+        write_group(df.assign(**{KEY: [None, 'R002', 'R003']}), 'cohort', tmp_path)
+    assert not (tmp_path / 'cohort.parquet').exists()
+
+
+def test_upsert_replaces_only_the_given_patients(tmp_path):
+    write_group(pd.DataFrame({KEY: ['R001', 'R002'], 'steps': [5000.0, 6000.0]}), 'steps', tmp_path)
+
+    upsert_group(pd.DataFrame({KEY: ['R002', 'R003'], 'steps': [6500.0, 7000.0], 'unused': [1, 2]}), 'steps',
+                 tmp_path, ['steps'])
+
+    stored = read_group('steps', tmp_path).sort_values(KEY, ignore_index=True)
+    pd.testing.assert_frame_equal(stored, pd.DataFrame({KEY: ['R001', 'R002', 'R003'], 'steps': [5000.0, 6500.0, 7000.0]}))
+
+    # upserting into a group that does not exist yet writes it
+    upsert_group(pd.DataFrame({KEY: ['R001'], 'RMSSD': [40.0]}), 'short_term_hrv', tmp_path)
+    assert list(read_group('short_term_hrv', tmp_path)[KEY]) == ['R001']
+
+
+def test_load_features_joins_on_the_cohort(tmp_path):
+    write_group(cohort(), 'cohort', tmp_path)
+    write_group(pd.DataFrame({KEY: ['R003', 'R001'], 'steps': [7000.0, 5000.0]}), 'steps', tmp_path)
+    write_group(pd.DataFrame({KEY: ['R002'], 'RMSSD': [35.0]}), 'activity_hr', tmp_path)
+
+    df = load_features(tmp_path)
+    assert list(df.columns) == [KEY, 'file_name', 'Wear time', 'RMSSD', 'steps']
+    assert list(df[KEY]) == ['R001', 'R002', 'R003']
+    np.testing.assert_array_equal(df['steps'], [5000.0, np.nan, 7000.0])
+
+    df = load_features(tmp_path, groups=['cohort', 'steps'], columns=['steps'])
+    assert list(df.columns) == [KEY, 'steps']
+
+    write_group(pd.DataFrame({KEY: ['R001'], 'steps': [1.0]}), 'legacy', tmp_path)
+    with pytest.raises(ValueError, match="'steps'"):
+        load_features(tmp_path)
+
+    with pytest.raises(FileNotFoundError):
+        load_features(tmp_path / 'empty')
+
+
+def test_import_csv(tmp_path):
+    df = cohort().assign(steps=[5000.0, 6000.0, 7000.0], RMSSD=[40.0, 35.0, 30.0], SDNN24=[120.0, 110.0, 100.0])
+    df.to_csv(tmp_path / 'sensors_data.csv', index=False)
+
+    written = import_csv(tmp_path / 'sensors_data.csv', tmp_path / 'store')
+
+    assert written == {'cohort': ['file_name', 'Wear time'], 'steps': ['steps'], 'short_term_hrv': ['RMSSD'],
+                       'legacy': ['SDNN24']}
+    assert group_file(tmp_path / 'store', 'legacy') == str(tmp_path / 'store' / 'legacy.parquet')
+    pd.testing.assert_frame_equal(load_features(tmp_path / 'store')[df.columns], df)
@@ -0,0 +1,70 @@
+import warnings
+import numpy as np
+import pytest
+
+from hrv_metrics import HRV_COLUMNS, compute_hrv_batch
+
+
+def nn_series(n_series=20, seed=0):
+    """
+    Synthetic NN interval series in ms of different lengths, with ectopic beats, including at both ends.
+    """
+    rng = np.random.default_rng(seed)
+    series = []
+    for k in range(n_series):
+        n = rng.integers(40, 400)
+        nn = 800 + 50*np.sin(np.arange(n)/5) + rng.normal(0, 30, n)
+        for j in rng.integers(0, n, rng.integers(0, 10)):
+            nn[j] *= rng.choice([0.5, 1.6])
+        if k % 4 == 0:
+            nn[0] *= 1.7
+            nn[-1] *= 1.8
+        series.append(nn)
+    return series
+
+
+@pytest.fixture
+def hrvanalysis(monkeypatch):
+    hrvanalysis = pytest.importorskip('hrvanalysis')
+    # hrvanalysis calls np.trapz, which numpy 2 removed
+    monkeypatch.setattr(np, 'trapz', np.trapezoid, raising=False)
+    return hrvanalysis
+
+
+def test_batch_matches_hrvanalysis(hrvanalysis):
+    series = nn_series()
+    hrv_df = compute_hrv_batch(series)
+
+    rows, ectopic = [], []
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for nn in series:
+            nn = hrvanalysis.remove_ectopic_beats(list(nn), verbose=False)
+            ectopic.append(int(np.isnan(nn).sum()))
+            nn = hrvanalysis.interpolate_nan_values(nn)
+            time_domain = hrvanalysis.get_time_domain_features(nn)
+            frequency_domain = hrvanalysis.get_frequency_domain_features(nn, method='welch')
+            poincare = hrvanalysis.get_poincare_plot_features(nn)
+            rows.append([time_domain['rmssd'], time_domain['sdnn'], time_domain['pnni_50'], time_domain['mean_nni'],
+                         frequency_domain['lf'], frequency_domain['vlf'], frequency_domain['hf'],
+                         frequency_domain['lf_hf_ratio'], poincare['sd1'], poincare['sd2']])
+
+    np.testing.assert_array_equal(hrv_df['ectopic_beats'], ectopic)
+    np.testing.assert_allclose(hrv_df[HRV_COLUMNS].to_numpy(), np.array(rows), rtol=1e-9)
+
+
+def test_padding_does_not_change_results():
+    series = nn_series(seed=1)
+    hrv_df = compute_hrv_batch(series, index=[f'R{k:03d}' for k in range(len(series))])
+
+    for k, nn in enumerate(series):
+        single = compute_hrv_batch([nn])
+        np.testing.assert_allclose(hrv_df.iloc[k][HRV_COLUMNS].to_numpy(dtype=float),
+                                   single.iloc[0][HRV_COLUMNS].to_numpy(dtype=float), rtol=1e-12)
+    assert list(hrv_df.index) == [f'R{k:03d}' for k in range(len(series))]
+
+
+def test_empty_batch():
+    hrv_df = compute_hrv_batch([])
+    assert len(hrv_df) == 0
+    assert list(hrv_df.columns) == HRV_COLUMNS + ['ectopic_beats']
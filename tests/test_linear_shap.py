@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.linear_model import Lasso
+from sklearn.preprocessing import StandardScaler
+
+from linear_shap import linear_shap, group_shap, shap_importance, resampled_shap
+from nested_cv import repeated_kfold_splits, run_resampled_cv
+
+
+FEATURES = ['steps', 'Q95', 'age', 'bmi', 'MeanNN', 'VLF']
+FEATURE_GROUPS = {'Anthropometrics': ['age', 'bmi'], 'Physical Activity': ['steps', 'Q95'], 'Short-Term HRV': ['MeanNN']}
+
+
+@pytest.fixture
+def df():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.normal(size=(90, len(FEATURES))) * 5 + 10, columns=FEATURES)
+    df['vo2peak_measured'] = 25 + df[FEATURES].to_numpy() @ np.array([0.3, 0.2, -0.1, -0.2, 0.05, 0.0]) \
+        + rng.normal(0, 1, 90)
+    return df
+
+
+@pytest.fixture
+def fitted(df):
+    scaler = StandardScaler().fit(df[FEATURES])
+    model = Lasso(alpha=0.05).fit(scaler.transform(df[FEATURES].iloc[:60]), df['vo2peak_measured'].iloc[:60])
+    return model, scaler
+
+
+def test_values_add_up_to_the_prediction(df, fitted):
+    model, scaler = fitted
+    X, background = df[FEATURES].iloc[60:], df[FEATURES].iloc[:60]
+
+    shap_values, base_value = linear_shap(model, scaler, X, background)
+
+    np.testing.assert_allclose(base_value + shap_values.sum(axis=1), model.predict(scaler.transform(X)), atol=1e-10)
+    np.testing.assert_allclose(shap_values, linear_shap(model, None, scaler.transform(X), scaler.transform(background))[0])
+
+
+def test_matches_shap_explainer(df, fitted):
+    shap = pytest.importorskip('shap')
+    model, scaler = fitted
+    X, background = scaler.transform(df[FEATURES].iloc[60:]), scaler.transform(df[FEATURES].iloc[:60])
+
+    # shap subsamples backgrounds of more than 100 rows, so the background here is kept smaller
+    explanation = shap.Explainer(model, background)(X)
+    shap_values, base_value = linear_shap(model, None, X, background)
+
+    np.testing.assert_allclose(shap_values, explanation.values, atol=1e-10)
+    assert base_value == pytest.approx(explanation.base_values[0])
+
+
+def test_group_values(df, fitted):
+    model, scaler = fitted
+    shap_values, _ = linear_shap(model, scaler, df[FEATURES].iloc[60:], df[FEATURES].iloc[:60])
+
+    group_values = group_shap(shap_values, FEATURES, FEATURE_GROUPS)
+    assert list(group_values.columns) == list(FEATURE_GROUPS) + ['Other']
+    np.testing.assert_allclose(group_values['Anthropometrics'], shap_values[:, 2] + shap_values[:, 3])
+    np.testing.assert_allclose(group_values['Other'], shap_values[:, 5])
+    np.testing.assert_allclose(group_values.sum(axis=1), shap_values.sum(axis=1))
+
+    importance = shap_importance(shap_values, FEATURES, FEATURE_GROUPS)
+    assert importance['Mean Absolute SHAP Value'].is_monotonic_decreasing
+    assert importance.set_index('Feature').loc['VLF', 'Group'] == 'Other'
+
+
+def test_resampled_shap_reuses_the_fold_models(df):
+    feature_sets = {'With HRV': FEATURES}
+    splits = repeated_kfold_splits(len(df), n_repeats=1)
+    results = run_resampled_cv(df, feature_sets, splits, n_jobs=1)
+
+    feature_importance, group_importance = resampled_shap(results, df, feature_sets, splits, 'With HRV', FEATURE_GROUPS)
+
+    for split, (_, row) in zip(splits, results.iterrows()):
+        # the fold model rebuilt from its stored coefficients and scaler statistics
+        model = Lasso()
+        model.coef_, model.intercept_ = row['coef'], row['intercept']
+        scaler = StandardScaler()
+        scaler.mean_, scaler.scale_ = row['scale_mean'], row['scale_std']
+        X = df[FEATURES].to_numpy()
+        shap_values, _ = linear_shap(model, scaler, X[split['test_index']], X[split['train_index']])
+
+        key = (split['scheme'], split['repeat'], split['fold'])
+        np.testing.assert_allclose(feature_importance.loc[key], np.abs(shap_values).mean(axis=0))
+        np.testing.assert_allclose(group_importance.loc[key],
+                                   group_shap(shap_values, FEATURES, FEATURE_GROUPS).abs().mean(axis=0))
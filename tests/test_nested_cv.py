@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import t as t_dist
+from sklearn.linear_model import LassoCV
+from sklearn.model_selection import KFold
+from sklearn.preprocessing import StandardScaler
+
+import nested_cv
+from nested_cv import (METRICS, fold_metrics, run_nested_cv, paired_differences, repeated_kfold_splits,
+                       bootstrap_splits, run_resampled_cv, paired_ci)
+
+
+FEATURE_SETS = {
+    "With HRV": {"features": ["a", "b", "c", "d", "e"]},
+    "Without HRV": {"features": ["a", "b", "c"]},
+}
+
+
+@pytest.fixture
+def df():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.normal(size=(80, 5)), columns=list("abcde"))
+    df["vo2peak_measured"] = 25 + 3*df["a"] - 2*df["b"] + 1.5*df["d"] + rng.normal(0, 1, 80)
+    return df
+
+
+def test_matches_original_fold_loop(df):
+    fold_df, models = run_nested_cv(df, FEATURE_SETS, n_jobs=1, return_models=True)
+
+    # the per-fold loop of the original analysis: features scaled on all patients, LassoCV on each training set
+    y = df["vo2peak_measured"].to_numpy()
+    for label, params in FEATURE_SETS.items():
+        X = StandardScaler().fit_transform(df[params["features"]])
+        for fold, (train_index, test_index) in enumerate(KFold(5, shuffle=True, random_state=42).split(X)):
+            lasso = LassoCV(cv=5, random_state=42).fit(X[train_index], y[train_index])
+            row = fold_df[(fold_df["feature_set"] == label) & (fold_df["fold"] == fold)].iloc[0]
+
+            assert row["alpha"] == pytest.approx(lasso.alpha_, rel=1e-9)
+            expected = fold_metrics(y[test_index], lasso.predict(X[test_index]))
+            for metric in METRICS:
+                assert row[metric] == pytest.approx(expected[metric], rel=1e-6)
+            np.testing.assert_array_equal(models[(label, fold)]["test_index"], test_index)
+
+
+def test_paired_differences(df):
+    fold_df = run_nested_cv(df, FEATURE_SETS, n_jobs=1)
+    differences = paired_differences(fold_df, "With HRV", "Without HRV")
+
+    with_hrv = fold_df[fold_df["feature_set"] == "With HRV"].set_index("fold")[METRICS]
+    without_hrv = fold_df[fold_df["feature_set"] == "Without HRV"].set_index("fold")[METRICS]
+    pd.testing.assert_frame_equal(differences, with_hrv - without_hrv)
+
+
+def test_first_repeat_matches_nested_cv(df, monkeypatch):
+    monkeypatch.setattr(nested_cv, "_fold_cache", {})
+    fold_df = run_nested_cv(df, FEATURE_SETS, n_jobs=1)
+    results = run_resampled_cv(df, FEATURE_SETS, repeated_kfold_splits(len(df), n_repeats=2), n_jobs=1)
+
+    first_repeat = results[results["repeat"] == 0].reset_index(drop=True)
+    columns = ["feature_set", "fold", "alpha", "n_selected"] + METRICS
+    pd.testing.assert_frame_equal(first_repeat[columns], fold_df[columns], check_dtype=False)
+
+
+def test_cached_splits_are_reused(df, monkeypatch, tmp_path):
+    monkeypatch.setattr(nested_cv, "_fold_cache", {})
+    splits = repeated_kfold_splits(len(df), n_repeats=2) + bootstrap_splits(len(df), n_boot=3)
+    results = run_resampled_cv(df, FEATURE_SETS, splits, n_jobs=1, cache_dir=str(tmp_path))
+    assert len(list(tmp_path.glob("*.pkl"))) == len(splits) * len(FEATURE_SETS)
+
+    # a new session reads every split back from cache_dir instead of fitting it again
+    def no_fit(*args, **kwargs):
+        raise AssertionError("split refitted")
+    monkeypatch.setattr(nested_cv, "_fold_cache", {})
+    monkeypatch.setattr(nested_cv, "evaluate_split", no_fit)
+    cached = run_resampled_cv(df, FEATURE_SETS, splits, n_jobs=1, cache_dir=str(tmp_path))
+    pd.testing.assert_frame_equal(cached.drop(columns=["coef", "scale_mean", "scale_std"]),
+                                  results.drop(columns=["coef", "scale_mean", "scale_std"]))
+
+    # a change of the data changes the key, so nothing is reused
+    monkeypatch.undo()
+    monkeypatch.setattr(nested_cv, "_fold_cache", {})
+    changed = df.assign(vo2peak_measured=df["vo2peak_measured"] + 1)
+    run_resampled_cv(changed, FEATURE_SETS, splits[:1], n_jobs=1, cache_dir=str(tmp_path))
+    assert len(list(tmp_path.glob("*.pkl"))) == (len(splits) + 1) * len(FEATURE_SETS)
+
+
+def test_splits_are_stable_when_extended():
+    assert [split["test_index"].tolist() for split in repeated_kfold_splits(30, n_repeats=2)] == \
+        [split["test_index"].tolist() for split in repeated_kfold_splits(30, n_repeats=4)[:10]]
+
+    for short, long in zip(bootstrap_splits(30, n_boot=3), bootstrap_splits(30, n_boot=6)):
+        np.testing.assert_array_equal(short["train_index"], long["train_index"])
+    for split in bootstrap_splits(30, n_boot=6):
+        assert not np.isin(split["test_index"], split["train_index"]).any()
+        assert len(np.union1d(split["test_index"], split["train_index"])) == 30
+
+
+def test_paired_ci():
+    rng = np.random.default_rng(2)
+    rows = []
+    for scheme, n_repeats, n_folds in [("repeated_kfold", 10, 5), ("bootstrap", 50, 1)]:
+        for repeat in range(n_repeats):
+            for fold in range(n_folds):
+                a = rng.normal(0.6, 0.05, len(METRICS))
+                b = a - rng.normal(0.02, 0.01, len(METRICS))
+                for label, values in [("With HRV", a), ("Without HRV", b)]:
+                    rows.append({"feature_set": label, "scheme": scheme, "repeat": repeat, "fold": fold,
+                                 "n_train": 64, "n_test": 16, **dict(zip(METRICS, values))})
+    results = pd.DataFrame(rows)
+
+    summary = paired_ci(results, "With HRV", "Without HRV", level=0.95).set_index(["scheme", "metric"])
+
+    by_model = results.set_index(["scheme", "feature_set", "repeat", "fold"]).sort_index()
+    for metric in METRICS:
+        diff = (by_model.loc[("repeated_kfold", "With HRV"), metric]
+                - by_model.loc[("repeated_kfold", "Without HRV"), metric]).to_numpy()
+        # Nadeau and Bengio corrected resampled t interval
+        half_width = t_dist.ppf(0.975, len(diff) - 1) * np.sqrt((1/len(diff) + 16/64) * np.var(diff, ddof=1))
+        row = summary.loc[("repeated_kfold", metric)]
+        assert row["mean_diff"] == pytest.approx(diff.mean())
+        assert (row["ci_low"], row["ci_high"]) == pytest.approx((diff.mean() - half_width, diff.mean() + half_width))
+
+        diff = (by_model.loc[("bootstrap", "With HRV"), metric]
+                - by_model.loc[("bootstrap", "Without HRV"), metric]).to_numpy()
+        row = summary.loc[("bootstrap", metric)]
+        assert (row["ci_low"], row["ci_high"]) == pytest.approx(tuple(np.percentile(diff, [2.5, 97.5])))
+        assert row["n"] == 50
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+
+from hrv_metrics import HRV_COLUMNS, compute_hrv_batch, sliding_window_hrv
+from extraction_functions import night_hrv_windows
+
+
+FS = 250
+WINDOW_LEN = 10 * FS
+
+
+def beat_train(n_rows, seed=0):
+    """
+    Beat index of one continuous beat train without ectopic beats, with every 10 s window of acceptable quality.
+    """
+    rng = np.random.default_rng(seed)
+    n_beats = int(n_rows * 10 / 0.85)
+    rr = 0.85 + 0.04*np.sin(np.arange(n_beats) * 2*np.pi*0.25*0.85) + 0.01*rng.standard_normal(n_beats)
+    times = np.cumsum(rr)
+    positions = np.round(times[times < n_rows*10 - 0.01] * FS).astype(np.int64)
+    counts = np.bincount(positions // WINDOW_LEN, minlength=n_rows)
+    return {'beat_positions': positions, 'window_offsets': np.concatenate([[0], np.cumsum(counts)]),
+            'quality': np.ones(n_rows, dtype=np.int8), 'hr': np.zeros(n_rows, dtype=np.float32), 'fs': FS,
+            'window_len': WINDOW_LEN}
+
+
+def activity(n_rows, start='2024-06-01 20:00'):
+    """
+    10 s activity rows, asleep from 22:00 to 07:00 local time.
+    """
+    times = pd.date_range(start, periods=n_rows, freq='10s', tz='UTC')
+    hours = times.tz_convert('Europe/London').hour
+    return pd.DataFrame({'time': times, 'sleep': ((hours >= 22) | (hours < 7)).astype(int)})
+
+
+def test_sliding_windows_match_batch():
+    rng = np.random.default_rng(1)
+    nn = 850 + 40*np.sin(np.arange(2000) / 4) + rng.normal(0, 10, 2000)
+    starts = np.arange(0, 1700, 37)
+    stops = starts + rng.integers(60, 300, len(starts))
+
+    hrv_df = sliding_window_hrv(nn, starts, stops)
+    expected = compute_hrv_batch([nn[a:b] for a, b in zip(starts, stops)], remove_ectopic=False)
+
+    np.testing.assert_allclose(hrv_df[HRV_COLUMNS].to_numpy(float), expected[HRV_COLUMNS].to_numpy(float), rtol=1e-9)
+
+
+def test_no_window_gives_empty_frame():
+    hrv_df = sliding_window_hrv(np.full(100, 800.0), [], [])
+    assert len(hrv_df) == 0 and list(hrv_df.columns) == HRV_COLUMNS
+
+
+def test_night_windows_use_the_continuous_nn_series():
+    n_rows = 6 * 360
+    beat_index = beat_train(n_rows)
+    acc_df = activity(n_rows)
+
+    window_df, night_df = night_hrv_windows(beat_index, acc_df)
+
+    # every window is scored on the intervals between the beats of its own rows, with the intervals across the
+    # 10 s boundaries inside the window included
+    nn = np.diff(beat_index['beat_positions']) / FS * 1000
+    offsets = beat_index['window_offsets']
+    rows = ((window_df['start_time'].dt.tz_convert('UTC') - acc_df['time'].iloc[0]).dt.total_seconds() // 10).astype(int)
+    expected = compute_hrv_batch([nn[offsets[row]:offsets[row + 30] - 1] for row in rows], remove_ectopic=False)
+
+    assert len(window_df) > 0 and window_df['ectopic_beats'].sum() == 0
+    np.testing.assert_allclose(window_df[HRV_COLUMNS].to_numpy(float), expected[HRV_COLUMNS].to_numpy(float),
+                               rtol=1e-9)
+    assert night_df['n_windows'].sum() == len(window_df)
+
+
+def test_night_without_clean_sleep():
+    n_rows = 6 * 360
+    beat_index = beat_train(n_rows)
+    acc_df = activity(n_rows)
+
+    no_clean = dict(beat_index, quality=np.zeros(n_rows, dtype=np.int8))
+    for beat_index_case, acc_case in [(beat_index, acc_df.assign(sleep=0)), (no_clean, acc_df),
+                                      (beat_index, acc_df.iloc[:20])]:
+        window_df, night_df = night_hrv_windows(beat_index_case, acc_case)
+        assert len(window_df) == 0 and len(night_df) == 0
@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+import neurokit2 as nk
+
+from conftest import load_hr_module
+
+
+orphanidou_nk = load_hr_module('orphanidou_nk')
+
+FS = 250
+THRESH = 0.66
+
+
+@pytest.fixture(scope='module')
+def ecg_windows():
+    """
+    (n_windows, 2500) matrix of 10 s ECG windows: clean, noisy and flat stretches at several heart rates.
+    """
+    rng = np.random.default_rng(0)
+    ecg = np.concatenate([nk.ecg_simulate(duration=60, sampling_rate=FS, heart_rate=50 + 20*k, noise=0.02*k,
+                                          random_state=k) for k in range(3)])
+    ecg[5000:15000] += rng.normal(0, 0.5, 10000)
+    ecg[30000:32500] = 0.3
+    return ecg[:len(ecg)//2500*2500].reshape(-1, 2500)
+
+
+def test_batch_matches_scalar(ecg_windows):
+    quality, hr, beats = orphanidou_nk.assess_qual_hr_batch(ecg_windows, FS, THRESH, chunk_size=5)
+
+    compared = 0
+    for i, window in enumerate(ecg_windows):
+        try:
+            qual_i, hr_i, beats_i = orphanidou_nk.assess_qual_hr(window, FS, THRESH)
+        except ZeroDivisionError:
+            # the scalar version raises where no beat can build a template, the batch gives quality 0
+            assert quality[i] == 0 and hr[i] == 0
+            continue
+        assert quality[i] == qual_i
+        assert hr[i] == hr_i
+        assert list(beats[i]) == list(beats_i)
+        compared += 1
+
+    assert compared > 0
+    assert 0 < quality.sum() < len(ecg_windows)
+
+
+def test_batch_chunk_size_does_not_change_results(ecg_windows):
+    quality, hr, beats = orphanidou_nk.assess_qual_hr_batch(ecg_windows, FS, THRESH)
+    quality_chunked, hr_chunked, beats_chunked = orphanidou_nk.assess_qual_hr_batch(ecg_windows, FS, THRESH,
+                                                                                     chunk_size=4)
+
+    np.testing.assert_array_equal(quality, quality_chunked)
+    np.testing.assert_array_equal(hr, hr_chunked)
+    assert [list(b) for b in beats] == [list(b) for b in beats_chunked]
+
+
+def template_loop(sig, beats):
+    """
+    Per-sample loop calculate_template was written as, kept as the reference for the vectorised version.
+    """
+    tol = int(np.floor(orphanidou_nk.calculate_med_rr_int(beats)/2))
+    sum_waves = np.zeros(1 + 2*tol)
+    no_beats_used = 0
+    for beat_no in range(len(beats) - 1):
+        min_el, max_el = beats[beat_no] - tol, beats[beat_no] + tol
+        if min_el < 0 or max_el > beats[-1]:
+            continue
+        for i in range(len(sum_waves)):
+            sum_waves[i] += sig[min_el + i]
+        no_beats_used += 1
+    return sum_waves/no_beats_used
+
+
+def cc_loop(sig, beats, templ):
+    """
+    Per-beat np.corrcoef loop calculate_cc was written as, kept as the reference for the vectorised version.
+    """
+    tol = int(np.floor(orphanidou_nk.calculate_med_rr_int(beats)/2))
+    sum_cc = 0
+    no_beats_used = 0
+    for beat_no in range(len(beats) - 1):
+        min_el, max_el = beats[beat_no] - tol, beats[beat_no] + tol
+        if min_el < 0 or max_el > beats[-1]:
+            continue
+        sum_cc = np.add(sum_cc, np.corrcoef(sig[min_el:max_el + 1], templ)[0, 1])
+        no_beats_used += 1
+    return sum_cc/no_beats_used
+
+
+@pytest.mark.parametrize('use_numba', [False, True])
+def test_template_and_cc_match_loops(ecg_windows, use_numba):
+    _, _, beats = orphanidou_nk.assess_qual_hr_batch(ecg_windows, FS, THRESH)
+
+    compared = 0
+    for window, window_beats in zip(ecg_windows, beats):
+        if orphanidou_nk.assess_feasibility(window_beats, FS) == 0:
+            continue
+        try:
+            expected_templ = template_loop(window, window_beats)
+            expected_cc = cc_loop(window, window_beats, expected_templ)
+        except ZeroDivisionError:
+            continue
+
+        templ = orphanidou_nk.calculate_template(window, window_beats, use_numba=use_numba)
+        cc = orphanidou_nk.calculate_cc(window, window_beats, templ, use_numba=use_numba)
+        np.testing.assert_allclose(templ, expected_templ, rtol=1e-12, atol=1e-15)
+        np.testing.assert_allclose(cc, expected_cc, rtol=1e-12)
+        compared += 1
+
+    assert compared > 0
@@ -0,0 +1,89 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+from feature_store import KEY, upsert_group, read_group, write_group
+from pipeline import stale_patients, record_patients, stage_input_files
+
+
+@pytest.fixture
+def data(tmp_path):
+    """
+    Data folder with the inputs of the steps stage for three patients, and their rows of the cohort.
+    """
+    df = pd.DataFrame({KEY: ['R001', 'R002', 'R010'], 'file_name': ['a', 'b', 'c'],
+                       'Hours of data collected': [48.0, 72.0, np.nan]})
+    for patient_id, file_name in zip(df[KEY], df['file_name']):
+        for file in stage_input_files('steps', str(tmp_path), patient_id, file_name):
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            with open(file, 'w') as f:
+                f.write(patient_id)
+    return tmp_path, df
+
+
+def compute(df, stale, path):
+    """
+    Run the steps stage for the stale patients: write their rows and record what they were computed from.
+    """
+    stale_ids, signatures = stale
+    upsert_group(df[df[KEY].isin(stale_ids)].assign(steps=1.0), 'steps', str(path / 'store'), ['steps'])
+    record_patients(str(path / 'store'), 'steps', signatures, stale_ids)
+
+
+def find_stale(df, path, code='v1', **kwargs):
+    return stale_patients(df, 'steps', str(path / 'store'), str(path), code,
+                          params_columns=['Hours of data collected'], **kwargs)
+
+
+def test_only_changed_patients_are_stale(data):
+    path, df = data
+    assert stage_input_files('steps', str(path), 'R010', 'c')[0] == str(path / 'steps/counts/10_gait_hourly.csv')
+
+    stale = find_stale(df, path)
+    assert stale[0] == ['R001', 'R002', 'R010']
+    compute(df, stale, path)
+    assert find_stale(df, path)[0] == []
+
+    # a rewritten input file
+    file = stage_input_files('steps', str(path), 'R002', 'b')[1]
+    stat = os.stat(file)
+    os.utime(file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert find_stale(df, path)[0] == ['R002']
+
+    # a changed parameter, a changed code version and a forced run
+    changed = df.assign(**{'Hours of data collected': [50.0, 72.0, np.nan]})
+    assert find_stale(changed, path)[0] == ['R001', 'R002']
+    assert find_stale(df, path, code='v2')[0] == ['R001', 'R002', 'R010']
+    assert find_stale(df, path, force=True)[0] == ['R001', 'R002', 'R010']
+
+    # recording only the recomputed patient leaves the others up to date
+    compute(df, find_stale(df, path), path)
+    assert find_stale(df, path)[0] == []
+
+
+def test_patients_missing_from_the_group_are_stale(data):
+    path, df = data
+    compute(df, find_stale(df, path), path)
+
+    stored = read_group('steps', str(path / 'store'))
+    write_group(stored[stored[KEY] != 'R001'], 'steps', str(path / 'store'))
+    assert find_stale(df, path)[0] == ['R001']
+
+    # a new patient without inputs is stale until its features are written
+    added = pd.concat([df, pd.DataFrame({KEY: ['R011'], 'file_name': ['d'], 'Hours of data collected': [24.0]})])
+    assert find_stale(added, path)[0] == ['R001', 'R011']
+
+
+def test_content_hash_ignores_touched_files(data):
+    path, df = data
+    compute(df, find_stale(df, path, content_hash=True), path)
+
+    file = stage_input_files('steps', str(path), 'R001', 'a')[0]
+    stat = os.stat(file)
+    os.utime(file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert find_stale(df, path, content_hash=True)[0] == []
+
+    with open(file, 'w') as f:
+        f.write('changed')
+    assert find_stale(df, path, content_hash=True)[0] == ['R001']